@@ -0,0 +1,379 @@
+"""Benchmarks for the parts of PathFinderGTK that have to be fast.
+
+Generates a pair of synthetic backup folders (and a few big files to diff),
+then times the scanner, building the result tree and the file viewer's diffs,
+and prints the timings as JSON. Like the modules it measures, nothing here needs
+a display; the image benchmark only runs if GdkPixbuf can be imported.
+
+The generated files are kept and reused as long as the settings that made them
+do not change, so runs on the same machine compare like with like. They are
+read from the page cache after the first run, so the timings are for warm
+caches.
+"""
+import sys, os, time, math, json, zlib, struct, shutil, random, platform, argparse, importlib
+from statistics import median
+from PathfinderScan import ScanEngine, ScanIndex, ResultTree, user_cache_dir, DEFAULT_WORKERS, COMPARE_MODES, COMPARE_SHALLOW, COMPARE_HASH, CHANGED, LEFT_ONLY, RIGHT_ONLY, DIRECTORY
+from PathfinderDiff import diff_text, diff_lines, group_hunks, compare_binary, binary_diff_text, LineFile, DIFF_PAGE, DEFAULT_CONTEXT
+
+BENCH_VERSION = 1
+MANIFEST = "manifest.json"
+BENCHMARKS = ("scan", "tree", "diff", "binary", "image")
+EXTENSIONS = (".txt", ".jpg", ".dat", ".py", ".pdf")
+WORDS = ("backup", "folder", "file", "compare", "change", "left", "right", "tree", "scan", "block", "disk", "copy")
+MTIME = 1600000000 #generated files all get modification times from here on, so a new tree looks the same as the last
+MiB = 1024*1024
+
+class TreeExists(Exception):
+    pass
+
+def file_size(rng, min_size, max_size):
+    #Log-uniform, so most files are small and a few are big, like in a real home folder
+    return int(round(math.exp(rng.uniform(math.log(min_size + 1), math.log(max_size + 1))))) - 1
+
+def make_dirs(depth, fanout):
+    dirs = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [os.path.join(parent, f"d{n}") for parent in level for n in range(fanout)]
+        dirs.extend(level)
+    return dirs
+
+def write_file(path, data, mtime):
+    with open(path, 'wb') as file:
+        file.write(data)
+    os.utime(path, (mtime, mtime))
+
+def generate_tree(root, files, depth, fanout, min_size, max_size, changed, left_only, right_only, seed):
+    """Create root/left and root/right, two folders that differ in about the given fractions of files."""
+    rng = random.Random(seed)
+    data = rng.randbytes(max_size + 4096)
+    dirs = make_dirs(depth, fanout)
+    for side in ("left", "right"):
+        for relpath in dirs:
+            os.makedirs(os.path.join(root, side, relpath), exist_ok=True)
+
+    for number in range(files):
+        relpath = os.path.join(rng.choice(dirs), f"f{number}{EXTENSIONS[number % len(EXTENSIONS)]}")
+        start = rng.randrange(4096)
+        content = data[start:start + file_size(rng, min_size, max_size)]
+        mtime = MTIME + number
+        left = os.path.join(root, "left", relpath)
+        right = os.path.join(root, "right", relpath)
+        roll = rng.random()
+        if roll < changed:
+            if content:
+                position = rng.randrange(len(content))
+                changed_content = content[:position] + bytes([content[position] ^ 0xff]) + content[position + 1:]
+            else:
+                changed_content = b"\0"
+            write_file(left, content, mtime)
+            write_file(right, changed_content, mtime + 1)
+        elif roll < changed + left_only:
+            write_file(left, content, mtime)
+        elif roll < changed + left_only + right_only:
+            write_file(right, content, mtime)
+        else:
+            write_file(left, content, mtime)
+            write_file(right, content, mtime)
+
+def make_text(rng, lines):
+    return [f"{number:08d} " + " ".join(rng.choice(WORDS) for _ in range(6)) for number in range(lines)]
+
+def write_text_pair(path1, path2, lines, changes, rng):
+    text1 = make_text(rng, lines)
+    text2 = list(text1)
+    for _ in range(changes):
+        position = rng.randrange(len(text2))
+        action = rng.randrange(3)
+        if action == 0:
+            text2[position] = "changed " + text2[position]
+        elif action == 1:
+            text2.insert(position, "inserted line")
+        else:
+            del text2[position]
+    for path, text in ((path1, text1), (path2, text2)):
+        with open(path, 'w', encoding="utf-8") as file:
+            file.write("\n".join(text) + "\n")
+
+def write_binary_pair(path1, path2, size, changes, rng):
+    block = rng.randbytes(MiB + 4096)
+    with open(path1, 'wb') as file1, open(path2, 'wb') as file2:
+        for offset in range(0, size, MiB):
+            start = rng.randrange(4096)
+            data = block[start:start + min(MiB, size - offset)]
+            file1.write(data)
+            file2.write(data)
+        for _ in range(changes):
+            position = rng.randrange(size)
+            file2.seek(position)
+            file2.write(b"\0\1\2\3")
+
+def write_png(path, size, rng):
+    #Noise does not compress, so decoding it costs about as much as a photo of the same size
+    noise = rng.randbytes(size*3 + 4096)
+    rows = b"".join(b"\0" + noise[(row*97) % 4096:(row*97) % 4096 + size*3] for row in range(size))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    with open(path, 'wb') as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)))
+        file.write(chunk(b"IDAT", zlib.compress(rows, 6)))
+        file.write(chunk(b"IEND", b""))
+
+def prepare(root, config):
+    """Generate everything the benchmarks read, unless root already holds files made with the same config."""
+    manifest = os.path.join(root, MANIFEST)
+    try:
+        with open(manifest) as file:
+            if json.load(file) == config:
+                return False
+    except (OSError, ValueError):
+        pass
+    if os.path.isdir(root) and os.listdir(root):
+        if not os.path.exists(manifest):
+            raise TreeExists(f"{root} is not empty and was not made by this benchmark")
+        shutil.rmtree(root)
+
+    os.makedirs(root)
+    #An empty manifest marks the folder as ours until everything is written, so a generation that was stopped halfway is started again next time
+    with open(manifest, 'w') as file:
+        json.dump({}, file)
+    tree = config["tree"]
+    generate_tree(root, tree["files"], tree["depth"], tree["fanout"], tree["min_size"], tree["max_size"],
+                  tree["changed"], tree["left_only"], tree["right_only"], config["seed"])
+    rng = random.Random(config["seed"])
+    files = os.path.join(root, "files")
+    os.makedirs(files)
+    write_text_pair(os.path.join(files, "small1.txt"), os.path.join(files, "small2.txt"), config["text_lines"], config["text_changes"], rng)
+    write_text_pair(os.path.join(files, "large1.txt"), os.path.join(files, "large2.txt"), config["large_lines"], config["text_changes"], rng)
+    write_binary_pair(os.path.join(files, "binary1.bin"), os.path.join(files, "binary2.bin"), config["binary_size"]*MiB, config["binary_changes"], rng)
+    write_png(os.path.join(files, "image.png"), config["image_size"], rng)
+    with open(manifest, 'w') as file:
+        json.dump(config, file, indent=2)
+    return True
+
+def timed(function, repeat):
+    """Call function repeat times; returns the timings and whatever the last call returned."""
+    runs = []
+    extra = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        extra = function()
+        runs.append(time.perf_counter() - start)
+    result = {"seconds": round(min(runs), 4), "median": round(median(runs), 4), "runs": [round(run, 4) for run in runs]}
+    if extra:
+        result.update(extra)
+    return result
+
+def scan(left, right, workers, mode, index=None):
+    engine = ScanEngine(left, right, workers, index=index, compare_mode=mode)
+    results = list(engine.walk())
+    report = engine.stats.report()
+    return results, {"counts": report["counts"], "phase_seconds": report["phase_seconds"]}
+
+def build_tree(left, right, results):
+    #The same steps MainWindow.find_changes() and FileBrowser.add_items() take, without the icons and list store
+    tree = ResultTree(left, right)
+    dirs = {"": tree.ROOT}
+    new = []
+    def get_parent(relpath):
+        index = dirs.get(relpath)
+        if index is None:
+            parent = get_parent(os.path.dirname(relpath))
+            index = dirs[relpath] = tree.add(parent, os.path.basename(relpath), DIRECTORY)
+            new.append(index)
+        return index
+    for dcmp in results:
+        for names, change in ((dcmp.diff_files, CHANGED), (dcmp.left_only, LEFT_ONLY), (dcmp.right_only, RIGHT_ONLY)):
+            for name in names:
+                new.append(tree.add(get_parent(dcmp.relpath), name, change))
+    for index in new:
+        tree.link(index)
+    return tree
+
+def expand_tree(tree):
+    #Every row the list view would ask for if the whole tree were expanded
+    count = 0
+    pending = [tree.ROOT]
+    while pending:
+        children = tree.visible_children(pending.pop())
+        count += len(children)
+        pending.extend(child for child in children if tree.change[child] == DIRECTORY)
+    return count
+
+def diff_small(path1, path2):
+    #What FileViewer.compute_payload() does for text that fits in memory
+    with open(path1, encoding="utf-8") as file:
+        content1 = file.read()
+    with open(path2, encoding="utf-8") as file:
+        content2 = file.read()
+    text, ranges = diff_text(content1.splitlines(), content2.splitlines())
+    return {"lines_shown": text.count("\n"), "ranges": len(ranges)}
+
+def diff_large(path1, path2):
+    #What FileViewer.compute_hunks() and render_hunks() do for big files
+    files = [LineFile(path1), LineFile(path2)]
+    try:
+        ops = diff_lines(files[0].hashes, files[1].hashes, page=DIFF_PAGE)
+        hunks = [hunk for hunk in group_hunks(ops, DEFAULT_CONTEXT) if hunk[0] != "skip"]
+    finally:
+        for file in files:
+            file.close()
+    return {"lines": len(files[0].hashes), "hunks": len(hunks)}
+
+def diff_binary(path1, path2, count_blocks):
+    result = compare_binary(path1, path2, count_blocks=count_blocks)
+    binary_diff_text(result)
+    return {"differing_blocks": result.differing_blocks if count_blocks else None}
+
+def decode_image(path, size):
+    #What the file viewer's decode_image() does, minus making a texture
+    from gi.repository import GdkPixbuf
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, size, size, True)
+    return {"width": pixbuf.get_width(), "height": pixbuf.get_height()}
+
+def load_gdkpixbuf():
+    try:
+        import gi
+        gi.require_version("GdkPixbuf", "2.0")
+        importlib.import_module("gi.repository.GdkPixbuf")
+        return True
+    except (ImportError, ValueError):
+        return False
+
+def run(args):
+    root = args.tree
+    left = os.path.join(root, "left")
+    right = os.path.join(root, "right")
+    files = os.path.join(root, "files")
+    only = set(args.only)
+    results = {}
+
+    if "scan" in only:
+        for mode in args.modes:
+            print(f"Scanning ({mode})...", file=sys.stderr)
+            outcome = timed(lambda: scan(left, right, args.workers, mode)[1], args.repeat)
+            results[f"scan-{mode}"] = outcome
+        if args.index:
+            path = os.path.join(root, "index.sqlite3")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+            for name in ("scan-index-first", "scan-index-again"):
+                print(f"Scanning ({name})...", file=sys.stderr)
+                def indexed():
+                    index = ScanIndex(left, right, path)
+                    try:
+                        return scan(left, right, args.workers, COMPARE_SHALLOW, index)[1]
+                    finally:
+                        index.close()
+                #The first run fills the index, so it only makes sense once
+                results[name] = timed(indexed, 1 if name == "scan-index-first" else args.repeat)
+
+    if "tree" in only:
+        scan_results = scan(left, right, args.workers, COMPARE_SHALLOW)[0]
+        print("Building result trees...", file=sys.stderr)
+        results["tree-build"] = timed(lambda: {"entries": len(build_tree(left, right, scan_results))}, args.repeat)
+        tree = build_tree(left, right, scan_results)
+        results["tree-expand"] = timed(lambda: {"rows": expand_tree(tree)}, args.repeat)
+
+    if "diff" in only:
+        print("Diffing text...", file=sys.stderr)
+        results["diff-text"] = timed(lambda: diff_small(os.path.join(files, "small1.txt"), os.path.join(files, "small2.txt")), args.repeat)
+        results["diff-hunks"] = timed(lambda: diff_large(os.path.join(files, "large1.txt"), os.path.join(files, "large2.txt")), args.repeat)
+
+    if "binary" in only:
+        print("Comparing binary files...", file=sys.stderr)
+        path1 = os.path.join(files, "binary1.bin")
+        path2 = os.path.join(files, "binary2.bin")
+        results["binary-count"] = timed(lambda: diff_binary(path1, path2, True), args.repeat)
+        results["binary-first"] = timed(lambda: diff_binary(path1, path2, False), args.repeat)
+
+    if "image" in only:
+        if load_gdkpixbuf():
+            print("Decoding images...", file=sys.stderr)
+            results["image-decode"] = timed(lambda: decode_image(os.path.join(files, "image.png"), args.image_view), args.repeat)
+        else:
+            results["image-decode"] = {"skipped": "GdkPixbuf is not available"}
+
+    return results
+
+def compare_baseline(results, baseline, out):
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if not old or "seconds" not in result or "seconds" not in old:
+            continue
+        change = (result["seconds"] - old["seconds"])/old["seconds"]*100 if old["seconds"] else 0.0
+        print(f"{name}: {result['seconds']:.4f} s, was {old['seconds']:.4f} s ({change:+.1f}%)", file=out)
+
+def main(argv=None):
+    """Generate the test files if needed, run the benchmarks and print the results as JSON."""
+    parser = argparse.ArgumentParser(prog="PathfinderBench.py", description="Time PathFinderGTK's scanner and file viewer on generated files.")
+    parser.add_argument("--tree", default=os.path.join(user_cache_dir(), "bench"), help="folder for the generated files (default: %(default)s)")
+    parser.add_argument("--files", type=int, default=20000, help="files in the generated folders (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=3, help="levels of subfolders (default: %(default)s)")
+    parser.add_argument("--fanout", type=int, default=8, help="subfolders in each folder (default: %(default)s)")
+    parser.add_argument("--min-size", type=int, default=0, help="smallest file size in bytes (default: %(default)s)")
+    parser.add_argument("--max-size", type=int, default=64*1024, help="largest file size in bytes (default: %(default)s)")
+    parser.add_argument("--changed", type=float, default=0.02, help="fraction of files that differ (default: %(default)s)")
+    parser.add_argument("--left-only", type=float, default=0.01, help="fraction of files only in the left folder (default: %(default)s)")
+    parser.add_argument("--right-only", type=float, default=0.01, help="fraction of files only in the right folder (default: %(default)s)")
+    parser.add_argument("--text-lines", type=int, default=20000, help="lines in the text files diffed in full (default: %(default)s)")
+    parser.add_argument("--large-lines", type=int, default=500000, help="lines in the text files diffed as hunks (default: %(default)s)")
+    parser.add_argument("--text-changes", type=int, default=200, help="lines changed, added or removed in each text file (default: %(default)s)")
+    parser.add_argument("--binary-size", type=int, default=256, help="size of the binary files in MiB (default: %(default)s)")
+    parser.add_argument("--binary-changes", type=int, default=16, help="places the binary files differ (default: %(default)s)")
+    parser.add_argument("--image-size", type=int, default=4000, help="width and height of the image in pixels (default: %(default)s)")
+    parser.add_argument("--image-view", type=int, default=1024, help="size the image is decoded to (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated files (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of scanning threads (default: %(default)s)")
+    parser.add_argument("--modes", type=lambda value: value.split(","), default=[COMPARE_SHALLOW, COMPARE_HASH],
+                        help=f"comma separated comparison modes to scan with, from {', '.join(COMPARE_MODES)} (default: shallow,hash)")
+    parser.add_argument("--index", action="store_true", help="also time scans that use a scan index")
+    parser.add_argument("--only", type=lambda value: value.split(","), default=list(BENCHMARKS),
+                        help=f"comma separated benchmarks to run, from {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="times each benchmark is run; the fastest run is reported (default: %(default)s)")
+    parser.add_argument("--output", help="write the results to this file instead of printing them")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+    for mode in args.modes:
+        if mode not in COMPARE_MODES:
+            parser.error(f"unknown comparison mode {mode!r}")
+    for name in args.only:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+    args.repeat = max(1, args.repeat)
+
+    config = {"version": BENCH_VERSION, "seed": args.seed,
+              "tree": {"files": args.files, "depth": args.depth, "fanout": args.fanout, "min_size": args.min_size, "max_size": args.max_size,
+                       "changed": args.changed, "left_only": args.left_only, "right_only": args.right_only},
+              "text_lines": args.text_lines, "large_lines": args.large_lines, "text_changes": args.text_changes,
+              "binary_size": args.binary_size, "binary_changes": args.binary_changes, "image_size": args.image_size}
+    started = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    try:
+        start = time.perf_counter()
+        if prepare(args.tree, config):
+            print(f"Generated test files in {args.tree} in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        results = run(args)
+    except (OSError, ValueError, TreeExists) as error:
+        print(error, file=sys.stderr)
+        return 2
+
+    output = {"started": started, "python": platform.python_version(), "platform": platform.platform(),
+              "cpus": os.cpu_count(), "workers": args.workers, "repeat": args.repeat, "config": config, "results": results}
+    text = json.dumps(output, indent=2) + "\n"
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        sys.stdout.write(text)
+    if baseline:
+        compare_baseline(results, baseline, sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""Copying used by PathFinderGTK to resolve differences.
+
+Like PathfinderScan, nothing in here imports GTK. Files are copied on a small
+pool of threads, by reflink where the filesystem supports it and otherwise
+with copy_file_range or sendfile, so the data does not pass through Python.
+"""
+import os, errno, shutil, threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+COPY_CHUNK = 8*1024*1024 #bytes copied between checks for cancellation
+DELTA_BLOCK = 1024*1024
+VERIFY_BLOCK = 1024*1024
+DEFAULT_WORKERS = 4
+TEMP_SUFFIX = ".pathfinder-part"
+FICLONE = 0x40049409 #from linux/fs.h
+
+#Errors that mean "not supported here" rather than that something went wrong
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+class CopyCancelled(Exception):
+    pass
+
+class CopyVerifyFailed(OSError):
+    pass
+
+class CopyProgress:
+    #Updated by the workers, read by whoever shows the progress
+    def __init__(self):
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.bytes_written = 0 #less than bytes_done when only changed blocks were written
+        self.lock = threading.Lock()
+
+    def add_file(self, size):
+        with self.lock:
+            self.files_total += 1
+            self.bytes_total += size
+
+    def add_bytes(self, count, written=None):
+        with self.lock:
+            self.bytes_done += count
+            self.bytes_written += count if written is None else written
+
+    def file_done(self):
+        with self.lock:
+            self.files_done += 1
+
+def temp_path(path):
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + TEMP_SUFFIX)
+
+class CopyEngine:
+    """Copies a file or a folder, reporting progress in self.progress.
+
+    Every file is written to a hidden temporary file next to its destination
+    and renamed into place once complete, so an interrupted copy never leaves
+    a half-written file behind. When a folder is copied, files already at the
+    destination with the same size and modification time are skipped, so
+    running the same copy again after cancelling it picks up where it left
+    off. cancellable is anything with an is_cancelled() method.
+
+    A file that replaces an existing file of at least delta_min_size bytes
+    is updated in place instead, writing only the blocks that differ, unless
+    the existing file has other hard links. With
+    verify set, every file is read back and compared once written.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, cancellable=None, delta_min_size=None, verify=False):
+        self.workers = max(1, workers)
+        self.cancellable = cancellable
+        self.delta_min_size = delta_min_size
+        self.verify = verify
+        self.progress = CopyProgress()
+        self.use_reflink = hasattr(os, "copy_file_range") #i.e. Linux
+        self.use_copy_range = hasattr(os, "copy_file_range")
+        self.use_sendfile = hasattr(os, "sendfile")
+        self.sparse = hasattr(os, "SEEK_DATA")
+
+    def check_cancelled(self):
+        if self.cancellable and self.cancellable.is_cancelled():
+            raise CopyCancelled()
+
+    def copy(self, src, dst):
+        if os.path.isdir(src):
+            dirs, files = self.plan(src, dst)
+            resume = True
+        else:
+            dirs = []
+            files = [(src, dst)]
+            self.progress.add_file(os.path.getsize(src))
+            resume = False
+
+        for dir_src, dir_dst in dirs:
+            os.makedirs(dir_dst, exist_ok=True)
+        self.copy_files(files, resume)
+        #Only once everything inside is written, or the modification times would change again
+        for dir_src, dir_dst in reversed(dirs):
+            shutil.copystat(dir_src, dir_dst)
+
+    def move(self, src, dst):
+        #For data that is already on the right disk under another name; never replaces anything at dst
+        self.check_cancelled()
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        self.progress.add_file(0)
+        os.rename(src, dst)
+        self.progress.file_done()
+
+    def plan(self, src, dst):
+        dirs = [(src, dst)]
+        files = []
+        pending = [(src, dst)]
+        while pending:
+            self.check_cancelled()
+            dir_src, dir_dst = pending.pop()
+            with os.scandir(dir_src) as entries:
+                for entry in entries:
+                    target = os.path.join(dir_dst, entry.name)
+                    if entry.is_dir():
+                        dirs.append((entry.path, target))
+                        pending.append((entry.path, target))
+                    elif entry.is_file() and not entry.name.endswith(TEMP_SUFFIX):
+                        files.append((entry.path, target))
+                        self.progress.add_file(entry.stat().st_size)
+        return dirs, files
+
+    def copy_files(self, files, resume):
+        pool = ThreadPoolExecutor(self.workers)
+        running = set()
+        try:
+            for src, dst in files:
+                if len(running) >= self.workers*2:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for job in done:
+                        job.result()
+                running.add(pool.submit(self.copy_file, src, dst, resume))
+            done, running = wait(running)
+            for job in done:
+                job.result()
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def copy_file(self, src, dst, resume=False):
+        self.check_cancelled()
+        st = os.stat(src)
+        if resume:
+            try:
+                existing = os.stat(dst)
+            except FileNotFoundError:
+                existing = None
+            if existing and existing.st_size == st.st_size and existing.st_mtime_ns == st.st_mtime_ns:
+                self.progress.add_bytes(st.st_size, 0)
+                self.progress.file_done()
+                return
+        if self.delta_min_size is not None and st.st_size >= self.delta_min_size and self.updatable(dst):
+            self.update_file(src, dst)
+            self.progress.file_done()
+            return
+
+        tmp = temp_path(dst)
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'w+b') as fdst:
+                self.copy_data(fsrc.fileno(), fdst.fileno(), st)
+                if self.verify:
+                    self.verify_data(fsrc.fileno(), fdst.fileno(), tmp)
+            shutil.copystat(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self.progress.file_done()
+
+    def copy_data(self, fin, fout, st):
+        size = st.st_size
+        if size and self.use_reflink and self.reflink(fin, fout):
+            self.progress.add_bytes(size)
+            return
+        if self.sparse and st.st_blocks*512 < size:
+            #Only copy the parts that hold data and leave the holes as holes
+            offset = 0
+            while offset < size:
+                try:
+                    start = os.lseek(fin, offset, os.SEEK_DATA)
+                except OSError as error:
+                    if error.errno != errno.ENXIO: #ENXIO: no more data
+                        raise
+                    break
+                end = os.lseek(fin, start, os.SEEK_HOLE)
+                self.progress.add_bytes(start - offset, 0)
+                self.copy_range(fin, fout, start, end - start)
+                offset = end
+            self.progress.add_bytes(max(0, size - offset), 0)
+            os.ftruncate(fout, size)
+        else:
+            self.copy_range(fin, fout, 0, size)
+
+    def reflink(self, fin, fout):
+        import fcntl
+        try:
+            fcntl.ioctl(fout, FICLONE, fin)
+            return True
+        except OSError as error:
+            if error.errno not in UNSUPPORTED:
+                raise
+            self.use_reflink = False #the same for every file of this copy
+            return False
+
+    def copy_range(self, fin, fout, offset, length):
+        end = offset + length
+        while offset < end:
+            self.check_cancelled()
+            copied = self.copy_chunk(fin, fout, offset, min(COPY_CHUNK, end - offset))
+            if not copied: #the source got shorter while being copied
+                break
+            offset += copied
+            self.progress.add_bytes(copied)
+
+    def copy_chunk(self, fin, fout, offset, count):
+        if self.use_copy_range:
+            try:
+                return os.copy_file_range(fin, fout, count, offset, offset)
+            except OSError as error:
+                if error.errno not in UNSUPPORTED:
+                    raise
+                self.use_copy_range = False
+        if self.use_sendfile:
+            try:
+                os.lseek(fout, offset, os.SEEK_SET)
+                return os.sendfile(fout, fin, offset, count)
+            except OSError as error:
+                if error.errno not in UNSUPPORTED:
+                    raise
+                self.use_sendfile = False
+        data = os.pread(fin, count, offset)
+        return os.pwrite(fout, data, offset)
+
+    def updatable(self, dst):
+        #A file with other hard links, such as one kept in older snapshots of a backup, must be replaced, not changed
+        try:
+            return os.path.isfile(dst) and os.stat(dst).st_nlink == 1
+        except FileNotFoundError:
+            return False
+
+    def update_file(self, src, dst):
+        #Unlike a normal copy this changes dst in place; if it is interrupted, running it again finishes the job
+        with open(src, 'rb', buffering=0) as fsrc, open(dst, 'r+b', buffering=0) as fdst:
+            offset = 0
+            while True:
+                self.check_cancelled()
+                data = fsrc.read(DELTA_BLOCK)
+                if not data:
+                    break
+                if fdst.read(len(data)) != data:
+                    os.pwrite(fdst.fileno(), data, offset)
+                    self.progress.add_bytes(len(data))
+                else:
+                    self.progress.add_bytes(len(data), 0)
+                offset += len(data)
+            fdst.truncate(offset)
+            if self.verify:
+                self.verify_data(fsrc.fileno(), fdst.fileno(), dst)
+        shutil.copystat(src, dst)
+
+    def verify_data(self, fin, fout, path):
+        #Written data is flushed and dropped from the page cache first, so it is read back from the disk
+        os.fsync(fout)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fout, 0, 0, os.POSIX_FADV_DONTNEED)
+        offset = 0
+        while True:
+            self.check_cancelled()
+            expected = os.pread(fin, VERIFY_BLOCK, offset)
+            if os.pread(fout, VERIFY_BLOCK, offset) != expected:
+                raise CopyVerifyFailed(errno.EIO, "Copy does not match the original", path)
+            if not expected:
+                break
+            offset += len(expected)
@@ -0,0 +1,492 @@
+"""Text comparison used by the PathFinderGTK file viewer.
+
+Like PathfinderScan, this does not import GTK, so diffs can be computed on a
+worker thread (or benchmarked without a display).
+"""
+import os, mmap, time, codecs
+from array import array
+from bisect import bisect_left
+try:
+    import charset_normalizer
+except ImportError:
+    charset_normalizer = None
+
+DEFAULT_MAX_EDITS = 1000
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_CONTEXT = 3
+SNIFF_SIZE = 8192
+BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"),
+        (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")) #UTF-32 first; its little-endian BOM starts with UTF-16's
+CHECK_LINES = 65536
+DIFF_PAGE = 65536 #lines compared at a time in big files
+BINARY_CHUNK = 16*1024*1024
+BINARY_BLOCK = 64*1024
+BINARY_HUNKS = 32 #differing blocks shown
+HUNK_ROWS = 8 #differing rows shown per block
+HEX_WIDTH = 16
+
+class DiffCancelled(Exception):
+    pass
+
+class DiffState:
+    def __init__(self, max_edits, deadline, cancellable):
+        self.max_edits = max_edits
+        self.deadline = deadline
+        self.cancellable = cancellable
+        self.exhausted = False #once set, everything left is compared line by line only
+
+    def check(self):
+        if self.cancellable and self.cancellable.is_cancelled():
+            raise DiffCancelled()
+        if self.deadline and time.monotonic() > self.deadline:
+            self.exhausted = True
+
+def unique_anchors(a, alo, ahi, b, blo, bhi):
+    """Pairs of lines that appear exactly once on each side, longest run that keeps their order (patience diff)."""
+    counts = {}
+    for i in range(alo, ahi):
+        line = a[i]
+        entry = counts.get(line)
+        counts[line] = [1, i, -1] if entry is None else [entry[0] + 1, i, -1]
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            if entry[0] == 1 and entry[2] == -1:
+                entry[2] = j
+            else:
+                entry[0] = 2 #seen more than once on one of the sides
+    pairs = sorted((i, j) for count, i, j in counts.values() if count == 1 and j != -1)
+
+    #Longest increasing subsequence of the b positions
+    tails = []
+    tail_index = []
+    previous = [-1]*len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        k = bisect_left(tails, j)
+        if k == len(tails):
+            tails.append(j)
+            tail_index.append(n)
+        else:
+            tails[k] = j
+            tail_index[k] = n
+        previous[n] = tail_index[k - 1] if k else -1
+    anchors = []
+    n = tail_index[-1] if tail_index else -1
+    while n != -1:
+        anchors.append(pairs[n])
+        n = previous[n]
+    anchors.reverse()
+    return anchors
+
+def myers(a, alo, ahi, b, blo, bhi, state):
+    """Shortest edit script between two ranges, or None if it needs more than state.max_edits edits."""
+    n = ahi - alo
+    m = bhi - blo
+    max_d = min(n + m, state.max_edits)
+    offset = max_d + 1
+    v = [0]*(2*max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        if d % 64 == 0:
+            state.check()
+            if state.exhausted:
+                return None
+        trace.append(v[:])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return backtrack(trace, offset, n, m, alo, blo)
+    return None
+
+def backtrack(trace, offset, x, y, alo, blo):
+    ops = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[offset + prev_k]
+        prev_y = prev_x - prev_k
+        run = min(x - prev_x, y - prev_y) if d > 0 else x
+        if run > 0:
+            ops.append(('equal', alo + x - run, alo + x, blo + y - run, blo + y))
+            x -= run
+            y -= run
+        if d > 0:
+            if x == prev_x:
+                ops.append(('insert', alo + x, alo + x, blo + prev_y, blo + y))
+            else:
+                ops.append(('delete', alo + prev_x, alo + x, blo + y, blo + y))
+        x, y = prev_x, prev_y
+    ops.reverse()
+    return ops
+
+def diff_range(a, alo, ahi, b, blo, bhi, state, ops):
+    #Matching lines at either end are common and cheap to take off first
+    start = alo
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        alo += 1
+        blo += 1
+    if alo > start:
+        add_equal(ops, start, alo, blo - (alo - start), blo)
+    end = ahi
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+
+    if alo == ahi or blo == bhi:
+        replace(alo, ahi, blo, bhi, ops)
+    else:
+        state.check()
+        anchors = [] if state.exhausted else unique_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for i, j in anchors:
+                diff_range(a, alo, i, b, blo, j, state, ops)
+                add_equal(ops, i, i + 1, j, j + 1)
+                alo, blo = i + 1, j + 1
+            diff_range(a, alo, ahi, b, blo, bhi, state, ops)
+        else:
+            script = myers(a, alo, ahi, b, blo, bhi, state)
+            if script is None:
+                replace(alo, ahi, blo, bhi, ops)
+            else:
+                ops.extend(script)
+
+    if end > ahi:
+        add_equal(ops, ahi, end, bhi, bhi + (end - ahi))
+
+def add_equal(ops, i1, i2, j1, j2):
+    #Runs of anchors would otherwise cost one opcode per line
+    if ops and ops[-1][0] == 'equal' and ops[-1][2] == i1 and ops[-1][4] == j1:
+        ops[-1] = ('equal', ops[-1][1], i2, ops[-1][3], j2)
+    else:
+        ops.append(('equal', i1, i2, j1, j2))
+
+def replace(alo, ahi, blo, bhi, ops):
+    if alo < ahi:
+        ops.append(('delete', alo, ahi, blo, blo))
+    if blo < bhi:
+        ops.append(('insert', ahi, ahi, blo, bhi))
+
+def diff_lines(a, b, max_edits=DEFAULT_MAX_EDITS, timeout=DEFAULT_TIMEOUT, cancellable=None, page=None):
+    """Compare two lists of lines and return opcodes like difflib.SequenceMatcher.get_opcodes().
+
+    Tags are 'equal', 'delete' and 'insert'. Lines that appear once in each
+    list anchor the comparison (patience diff) and the gaps between them are
+    compared with Myers' algorithm. A gap that needs more than max_edits
+    edits, or anything left once timeout seconds have passed, is shown as
+    removed and re-added instead. cancellable is anything with an
+    is_cancelled() method; DiffCancelled is raised once it is set.
+
+    With page set, the lists are compared page lines at a time (and timeout
+    applies to each page), so memory use does not grow with their length.
+    """
+    ops = []
+    alo = blo = 0
+    while True:
+        ahi = len(a) if not page else min(len(a), alo + page)
+        bhi = len(b) if not page else min(len(b), blo + page)
+        deadline = time.monotonic() + timeout if timeout else None
+        state = DiffState(max_edits, deadline, cancellable)
+        page_ops = []
+        diff_range(a, alo, ahi, b, blo, bhi, state, page_ops)
+        if ahi == len(a) and bhi == len(b):
+            ops.extend(page_ops)
+            break
+
+        #Keep everything up to the last run of matching lines that does not touch the end of the page;
+        #what comes after it is compared again as part of the next page
+        cut = None
+        for k in range(len(page_ops) - 1, -1, -1):
+            tag, i1, i2, j1, j2 = page_ops[k]
+            if tag == 'equal' and (i2 < ahi or ahi == len(a)) and (j2 < bhi or bhi == len(b)):
+                cut = k
+                break
+        if cut is None:
+            replace(alo, ahi, blo, bhi, ops)
+            alo, blo = ahi, bhi
+        else:
+            ops.extend(page_ops[:cut + 1])
+            alo, blo = page_ops[cut][2], page_ops[cut][4]
+
+    merged = []
+    for op in ops:
+        if merged and merged[-1][0] == op[0] and merged[-1][2] == op[1] and merged[-1][4] == op[3]:
+            last = merged[-1]
+            merged[-1] = (last[0], last[1], op[2], last[3], op[4])
+        else:
+            merged.append(op)
+    return merged
+
+def compare_lines(a, b, **kwargs):
+    """Yield lines in difflib.Differ's format ("  ", "- " and "+ " prefixes), without its "? " hint lines."""
+    for tag, i1, i2, j1, j2 in diff_lines(a, b, **kwargs):
+        if tag == 'equal':
+            for line in a[i1:i2]:
+                yield "  " + line
+        elif tag == 'delete':
+            for line in a[i1:i2]:
+                yield "- " + line
+        else:
+            for line in b[j1:j2]:
+                yield "+ " + line
+
+def diff_text(a, b, **kwargs):
+    """Like compare_lines, but joined into one string.
+
+    Returns (text, ranges) where ranges lists (tag, first_line, end_line)
+    for every 'delete' and 'insert' block, counted in lines of text.
+    """
+    parts = []
+    ranges = []
+    line = 0
+    for tag, i1, i2, j1, j2 in diff_lines(a, b, **kwargs):
+        if tag == 'insert':
+            prefix, lines = "+ ", b[j1:j2]
+        else:
+            prefix, lines = ("  " if tag == 'equal' else "- "), a[i1:i2]
+        if tag != 'equal':
+            ranges.append((tag, line, line + len(lines)))
+        parts.append("".join(prefix + text + "\n" for text in lines))
+        line += len(lines)
+    return "".join(parts), ranges
+
+class LineFile:
+    """The lines of a file, read through mmap.
+
+    Only where each line starts and a hash of each line are kept in memory
+    (16 bytes a line), so the hashes can be compared with diff_lines() and
+    the text itself is read back from the file when it is shown.
+    """
+    def __init__(self, path, check=None, encoding="utf-8"):
+        self.path = path
+        self.encoding = encoding
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.starts = array('q', [0])
+        self.hashes = array('q')
+
+        pos = 0
+        count = 0
+        readline = self.data.readline if size else (lambda: b"")
+        for line in iter(readline, b""):
+            pos += len(line)
+            self.starts.append(pos)
+            self.hashes.append(hash(line.rstrip(b"\r\n")))
+            count += 1
+            if check and count % CHECK_LINES == 0:
+                check()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lines(self, start, end):
+        data = self.data[self.starts[start]:self.starts[end]]
+        if not data:
+            return []
+        lines = data.decode(self.encoding, errors="replace").split("\n")
+        if not lines[-1]:
+            lines.pop()
+        return [line[:-1] if line.endswith("\r") else line for line in lines]
+
+    def close(self):
+        if self.data:
+            self.data.close()
+        self.file.close()
+
+def detect_encoding(data):
+    """Guess the encoding of text from the start of a file, or None if it does not look like text."""
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    if b"\0" in data:
+        return None
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(data) #not final, so a character cut off at the end is fine
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    if charset_normalizer:
+        match = charset_normalizer.from_bytes(data).best()
+        return match.encoding if match else None
+    return "latin-1"
+
+def is_line_encoding(encoding):
+    #Every b"\n" byte is a line break, so lines can be found without decoding the file
+    return not codecs.lookup(encoding).name.startswith(("utf-16", "utf-32"))
+
+def group_hunks(ops, context=DEFAULT_CONTEXT):
+    """Split opcodes from diff_lines() into hunks with a few unchanged lines of context around each change.
+
+    Yields ('skip', i1, i2, j1, j2) for the unchanged lines left out
+    between hunks, and each hunk as a list of opcodes.
+    """
+    hunk = []
+    last = len(ops) - 1
+    for k, op in enumerate(ops):
+        tag, i1, i2, j1, j2 = op
+        if tag != 'equal':
+            hunk.append(op)
+            continue
+        size = i2 - i1
+        if 0 < k < last and size <= 2*context:
+            hunk.append(op)
+            continue
+        head = min(context, size) if k > 0 else 0
+        tail = min(context, size - head) if k < last else 0
+        if head:
+            hunk.append(('equal', i1, i1 + head, j1, j1 + head))
+        if hunk:
+            yield hunk
+            hunk = []
+        if size > head + tail:
+            yield ('skip', i1 + head, i2 - tail, j1 + head, j2 - tail)
+        if tail:
+            hunk.append(('equal', i2 - tail, i2, j2 - tail, j2))
+    if hunk:
+        yield hunk
+
+def hunk_header(hunk):
+    first, last = hunk[0], hunk[-1]
+    return "@@ -%d,%d +%d,%d @@" % (first[1] + 1, last[2] - first[1], first[3] + 1, last[4] - first[3])
+
+class BinaryComparison:
+    __slots__ = ("sizes", "block", "blocks", "first_offset", "differing_blocks", "hunks")
+
+    def __init__(self, size1, size2, block):
+        self.sizes = (size1, size2)
+        self.block = block
+        self.blocks = -(-max(size1, size2)//block)
+        self.first_offset = None #None when the files are the same
+        self.differing_blocks = 0 #None when counting stopped at the first difference
+        self.hunks = [] #(offset, rows, rows left out) for the first few differing blocks
+
+def first_difference(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while hi - lo > 64:
+        mid = (lo + hi)//2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    for i in range(lo, hi):
+        if a[i] != b[i]:
+            return i
+    return hi
+
+def binary_rows(offset, data1, data2, limit):
+    rows = []
+    differing = 0
+    for start in range(0, max(len(data1), len(data2)), HEX_WIDTH):
+        row1 = data1[start:start + HEX_WIDTH]
+        row2 = data2[start:start + HEX_WIDTH]
+        if row1 != row2:
+            differing += 1
+            if len(rows) < limit:
+                rows.append((offset + start, row1, row2))
+    return rows, differing - len(rows)
+
+def compare_binary(path1, path2, count_blocks=True, block=BINARY_BLOCK, chunk=BINARY_CHUNK, max_hunks=BINARY_HUNKS, check=None):
+    """Compare two files byte for byte, a chunk at a time through mmap.
+
+    Stops at the first differing block unless count_blocks is set, in which
+    case every block of the files is compared. check is called between
+    chunks and may raise to stop early.
+    """
+    with open(path1, 'rb') as file1, open(path2, 'rb') as file2:
+        size1 = os.fstat(file1.fileno()).st_size
+        size2 = os.fstat(file2.fileno()).st_size
+        data1 = mmap.mmap(file1.fileno(), 0, access=mmap.ACCESS_READ) if size1 else b""
+        data2 = mmap.mmap(file2.fileno(), 0, access=mmap.ACCESS_READ) if size2 else b""
+        try:
+            result = BinaryComparison(size1, size2, block)
+            common = min(size1, size2)
+            last_block = None
+            for start in range(0, common, chunk):
+                if check:
+                    check()
+                end = min(start + chunk, common)
+                if data1[start:end] == data2[start:end]:
+                    continue
+                for offset in range(start, end, block):
+                    stop = min(offset + block, end)
+                    block1 = data1[offset:stop]
+                    block2 = data2[offset:stop]
+                    if block1 == block2:
+                        continue
+                    result.differing_blocks += 1
+                    last_block = offset
+                    if result.first_offset is None:
+                        result.first_offset = offset + first_difference(block1, block2)
+                    if len(result.hunks) < max_hunks:
+                        result.hunks.append((offset,) + binary_rows(offset, block1, block2, HUNK_ROWS))
+                    if not count_blocks:
+                        result.differing_blocks = None
+                        return result
+
+            if size1 != size2:
+                #Everything past the end of the shorter file differs
+                if result.first_offset is None:
+                    result.first_offset = common
+                if result.differing_blocks is not None:
+                    result.differing_blocks += result.blocks - common//block
+                    if last_block == common//block*block: #the block the shorter file ends in was already counted
+                        result.differing_blocks -= 1
+                if len(result.hunks) < max_hunks:
+                    result.hunks.append((common,) + binary_rows(common, data1[common:common + block], data2[common:common + block], HUNK_ROWS))
+            return result
+        finally:
+            if size1:
+                data1.close()
+            if size2:
+                data2.close()
+
+def hex_row(offset, data):
+    hex_part = " ".join("%02x" % byte for byte in data).ljust(HEX_WIDTH*3 - 1)
+    text_part = "".join(chr(byte) if 32 <= byte < 127 else "." for byte in data)
+    return "%08x  %s  |%s|" % (offset, hex_part, text_part)
+
+def binary_diff_text(result):
+    """Describe a BinaryComparison as text with ranges, like diff_text()."""
+    lines = []
+    ranges = []
+    size1, size2 = result.sizes
+    if result.first_offset is None:
+        lines.append("The files are the same.")
+    else:
+        lines.append(f"The files first differ at byte {result.first_offset} (0x{result.first_offset:x}).")
+        if result.differing_blocks is None:
+            lines.append("Differing blocks were not counted.")
+        else:
+            lines.append(f"{result.differing_blocks} of {result.blocks} blocks of {result.block//1024} KiB differ.")
+    if size1 != size2:
+        lines.append(f"Sizes: {size1} and {size2} bytes.")
+
+    for offset, rows, left_out in result.hunks:
+        lines.append("")
+        ranges.append(("hunk", len(lines), len(lines) + 1))
+        lines.append("@@ 0x%08x @@" % offset)
+        for row_offset, row1, row2 in rows:
+            if row1:
+                ranges.append(("delete", len(lines), len(lines) + 1))
+                lines.append("- " + hex_row(row_offset, row1))
+            if row2:
+                ranges.append(("insert", len(lines), len(lines) + 1))
+                lines.append("+ " + hex_row(row_offset, row2))
+        if left_out:
+            lines.append(f"  ... {left_out} more differing rows in this block")
+    if result.differing_blocks and result.differing_blocks > len(result.hunks):
+        lines.append("")
+        lines.append(f"  ... {result.differing_blocks - len(result.hunks)} more differing blocks")
+    return "".join(line + "\n" for line in lines), ranges
@@ -1,19 +1,46 @@
-import sys, os, subprocess, shutil
-from filecmp import dircmp
-import difflib, mimetypes
-import threading
+import time
+STARTUP_TIMES = [("start", time.perf_counter())]
+
+import sys, os, subprocess
+import threading, functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+
+if __name__ == "__main__" and sys.argv[1:2] == ["--cli"]:
+    #Headless mode: nothing below this point (GTK, settings, a display) is needed
+    import PathfinderScan
+    sys.exit(PathfinderScan.main(sys.argv[2:]))
+
 import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('Adw', '1')
 gi.require_version("GtkSource", "5")
-from gi.repository import Gio, Gtk, Adw, Gdk, GObject, GLib, GtkSource, GdkPixbuf, Pango
+from gi.repository import Gio, Gtk, Adw, Gdk, GObject, GLib, Pango
+import sqlite3
+from PathfinderDiff import diff_text, diff_lines, group_hunks, hunk_header, detect_encoding, is_line_encoding, compare_binary, binary_diff_text, LineFile, DiffCancelled, SNIFF_SIZE, DIFF_PAGE
+from PathfinderCopy import CopyEngine, CopyCancelled
+from PathfinderScan import ScanEngine, ScanIndex, ScanCancelled, ResultTree, write_report, UNCHANGED, CHANGED, LEFT_ONLY, RIGHT_ONLY, DIRECTORY, MOVED
+STARTUP_TIMES.append(("imports", time.perf_counter()))
+
+GtkSource = GdkPixbuf = None #loaded by load_viewer_modules() once a file is shown
 
 CHANGE_UNCHANGED = ("", "file-change-none", "file-change-none")
 CHANGE_CHANGED = ("Changed", "accent", "accent-button")
 CHANGE_LEFT = ("Not backed up", "warning", "warning-button")
 CHANGE_RIGHT = ("Only in backup", "missing", "missing-button")
+CHANGE_MOVED = ("Moved", "success", "success-button")
 CHANGE_UNKNOWN = ("", "file-change-unknown", "file-change-unknown")
+CHANGES = {UNCHANGED: CHANGE_UNCHANGED, CHANGED: CHANGE_CHANGED, LEFT_ONLY: CHANGE_LEFT, RIGHT_ONLY: CHANGE_RIGHT, DIRECTORY: CHANGE_UNKNOWN, MOVED: CHANGE_MOVED}
+DIFF_TAGS = {"insert": "addition", "delete": "removal", "hunk": "hunk"}
+DIFF_PREFIXES = {"equal": "  ", "delete": "- ", "insert": "+ "}
+HUNK_PAGE = 100 #hunks shown before asking to show more
+EXPAND_LINES = 1000 #unchanged lines shown per click on a collapsed region
+LINE_PAGE = 5000 #lines of a big file only on one side shown before asking to show more
+PREVIEW_WORKERS = 2
+SNIFF_CACHE_SIZE = 4096
+UNKNOWN_FILE_TYPE = ("application/octet-stream", "application/octet-stream", None)
+IMAGE_SIZE_STEP = 256 #decoded sizes are rounded up to this so small resizes reuse the cache
 SCHEMA_ID = "ca.andereoo.pathfindergtk"
 SCHEMA_PATH = "/usr/share/glib-2.0/schemas/"
 UPDATE_SCHEMA = False
@@ -25,9 +52,20 @@ NAME = "Pathfinder"
 DESCRIPTION = "Compare folders"
 AUTHOR = "Andereoo"
 ICON = "logviewer"
-
-gio_settings = Gio.Settings.new(SCHEMA_ID)
-gtk_settings = Gtk.Settings.get_default()
+DEFAULT_ICON = "text-x-generic"
+FLUSH_INTERVAL = 50 #ms between batches of scan results
+STATUS_INTERVAL = 0.25 #s between updates of the footer label
+AUTO_SCAN_DELAY = 500 #ms to wait for more folder changes before scanning automatically
+WATCH_DELAY = 500 #ms to collect file system events before updating the results
+WATCH_EVENTS = (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED,
+                Gio.FileMonitorEvent.ATTRIBUTE_CHANGED, Gio.FileMonitorEvent.RENAMED, Gio.FileMonitorEvent.MOVED_IN,
+                Gio.FileMonitorEvent.MOVED_OUT)
+DEBUG = bool(os.environ.get("PATHFINDER_DEBUG"))
+PROFILE = os.environ.get("PATHFINDER_PROFILE") #"cpu" leaves out memory tracing
+STARTUP_BENCHMARK = bool(os.environ.get("PATHFINDER_STARTUP_BENCHMARK"))
+
+gio_settings = None #created in main()
+profiler = None #created in main() if profiling is turned on
 
 #TO BE RUN BY INSTALLER
 if UPDATE_SCHEMA:
@@ -46,12 +84,52 @@ if UPDATE_SCHEMA:
     print("Please re-run this script with UPDATE_SCHEMA=False to run the application")
     quit() #Otherwise a breakpoint trap will occur later; file needs to be re-run
 
+def load_viewer_modules():
+    global GtkSource, GdkPixbuf
+    if GtkSource is None:
+        from gi.repository import GtkSource, GdkPixbuf
+
+def mark_startup(phase):
+    STARTUP_TIMES.append((phase, time.perf_counter()))
+    if STARTUP_BENCHMARK and phase == "first frame":
+        previous = STARTUP_TIMES[0][1]
+        for name, when in STARTUP_TIMES[1:]:
+            print(f"{name}: {(when - previous)*1000:.1f} ms", file=sys.stderr)
+            previous = when
+        print(f"total: {(previous - STARTUP_TIMES[0][1])*1000:.1f} ms", file=sys.stderr)
+
+def profiled(function, kind, last=False):
+    #Returns function itself unless profiling is turned on, so this costs next to nothing otherwise
+    return profiler.wrap(function, kind, last) if profiler else function
+
+def get_watch_limit():
+    #Leave most inotify watches to other programs; each watched pair of folders needs two
+    try:
+        with open("/proc/sys/fs/inotify/max_user_watches") as file:
+            return int(file.read())//8
+    except (OSError, ValueError):
+        return None
+
 def open_file(file):
     subprocess.call(('open', file))
 
 def show_file(file):
     subprocess.call(('nautilus', '--select', file))
 
+icon_cache = {}
+
+def get_icon_name(name, is_dir=False):
+    #Guessed from the name only; returns None when GIO would have to look inside the file
+    if is_dir:
+        return "folder"
+    content_type, uncertain = Gio.content_type_guess(name, None)
+    if uncertain:
+        return None
+    icon = icon_cache.get(content_type)
+    if icon is None:
+        icon = icon_cache[content_type] = Gio.content_type_get_icon(content_type).get_names()[0]
+    return icon
+
 class CustomFolderSelector(Gtk.Button):
     def __init__(self, master, settings_key, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -146,8 +224,14 @@ class FileBrowser(Gtk.ScrolledWindow):
         self.selection = selection = Gtk.SingleSelection.new(model)#MultiSelection
         factory = Gtk.SignalListItemFactory()
         self.view = view = Gtk.ListView.new(selection, factory) #Columnview
-        
-        model.set_autoexpand(True) #GtkTreeListRow.set_expanded     
+        self.autoexpand_depth = gio_settings.get_int("autoexpand-depth")
+        self.tree = None
+        self.wrappers = {} #ResultTree index -> DataObject, for rows that currently exist
+        self.auto_expanded = set()
+
+        #Rows are expanded up to autoexpand_depth as they are shown, see bind_list_item
+        model.set_autoexpand(False)
+        gio_settings.connect("changed::autoexpand-depth", self.on_autoexpand_depth_changed)
         factory.connect("setup", self.setup_list_item)
         factory.connect("bind", self.bind_list_item) 
 
@@ -156,10 +240,83 @@ class FileBrowser(Gtk.ScrolledWindow):
         view.add_css_class("navigation-sidebar") #rich-list
         #view.set_tab_behavior(Gtk.ListTabBehavior.LIST_TAB_ALL)
 
+    def set_tree(self, tree):
+        self.store.remove_all()
+        self.wrappers.clear()
+        self.auto_expanded.clear()
+        self.tree = tree
+
+    def wrap(self, index, store):
+        item = self.wrappers.get(index)
+        if item is None:
+            item = self.wrappers[index] = DataObject(self.tree, index)
+        item._store = store
+        return item
+
+    def add_items(self, indices):
+        #Takes newly found ResultTree entries and adds each group of siblings with a single splice
+        tree = self.tree
+        for index in indices:
+            tree.link(index)
+
+        top_level = []
+        stores = {}
+        for index in indices:
+            parent = tree.parent[index]
+            if parent == tree.ROOT:
+                top_level.append(self.wrap(index, self.store))
+            else:
+                parent_item = self.wrappers.get(parent)
+                if parent_item is not None and parent_item._filled:
+                    store = parent_item._child_store
+                    stores.setdefault(parent, (store, []))[1].append(self.wrap(index, store))
+
+        if top_level:
+            self.store.splice(self.store.get_n_items(), 0, top_level)
+        for store, items in stores.values():
+            store.splice(store.get_n_items(), 0, items)
+
     def remove_item(self, item):
-        found = item._store.find(item)
-        item._store.remove(found.position)
+        if item._store is not None:
+            found, position = item._store.find(item)
+            if found:
+                item._store.remove(position)
+        self.release_children(item)
+        self.wrappers.pop(item.index, None)
         item._is_visible = False
+
+    def remove_index(self, index):
+        item = self.wrappers.get(index)
+        if item is not None:
+            self.remove_item(item)
+        else:
+            self.tree.visible[index] = 0
+
+    def release_children(self, item):
+        for child in self.tree.children(item.index):
+            child_item = self.wrappers.pop(child, None)
+            if child_item is not None:
+                child_item._store = None
+                self.release_children(child_item)
+        item._child_store = None
+        item._filled = False
+
+    def on_autoexpand_depth_changed(self, settings, key):
+        self.autoexpand_depth = settings.get_int(key)
+
+    def on_row_expanded(self, row, pspec):
+        item = row.get_item()
+        store = item._child_store
+        if store is None:
+            return
+        if row.get_expanded():
+            if not item._filled:
+                children = [self.wrap(child, store) for child in self.tree.visible_children(item.index)]
+                store.splice(0, 0, children)
+                item._filled = True
+        else:
+            #GTK drops the child model of a collapsed row, so let go of it and the rows below it too
+            self.release_children(item)
     
     def on_right_click(self, controller, n_press, x, y):
         #self.selection.set_selected(controller._widget.get_position())
@@ -185,15 +342,14 @@ class FileBrowser(Gtk.ScrolledWindow):
             if type(item) == Gtk.TreeListRow:
                 item = item.get_item()
 
-            if not item._store:
+            if item._store is None:
                 item._store = self.store
 
-            if item.children:
-                store = Gio.ListStore.new(DataObject)
-                for child in item.children:
-                    if child._is_visible:
-                        store.append(child)
-                        child._store = store
+            #GTK also calls this just to find out whether a row can be expanded, so the
+            #store stays empty until the row really is expanded (see on_row_expanded)
+            if item.is_folder and self.tree.has_visible_children(item.index):
+                item._child_store = store = Gio.ListStore.new(DataObject)
+                item._filled = False
                 return store
             else:
                 return None
@@ -233,6 +389,7 @@ class FileBrowser(Gtk.ScrolledWindow):
         file_box.file_name = file_name
         file_box.file_change = file_change
         file_box.file_icon = file_icon
+        file_box.obj = None
 
     def bind_list_item(self, widget, item):
         expander = item.get_child()
@@ -241,12 +398,38 @@ class FileBrowser(Gtk.ScrolledWindow):
         expander.set_list_row(row)
         obj = row.get_item()
 
+        if obj.is_folder:
+            if not getattr(row, "_watched", False):
+                row.connect("notify::expanded", self.on_row_expanded)
+                row._watched = True
+            if row.get_expanded():
+                self.on_row_expanded(row, None)
+            elif obj.index not in self.auto_expanded and row.get_depth() < self.autoexpand_depth:
+                self.auto_expanded.add(obj.index)
+                GLib.idle_add(row.set_expanded, True) #changing the model while binding upsets the list view
+
+        file_box.obj = obj
         file_box.file_name.set_label(obj.name)
         file_box.file_change.set_label(obj.change[0])
-        file_box.file_icon.set_from_icon_name(obj.icon)
+        moved_from = obj.moved_from
+        file_box.set_tooltip_text(f"{moved_from} in the backup" if moved_from else None)
+        if obj.icon:
+            file_box.file_icon.set_from_icon_name(obj.icon)
+        else:
+            file_box.file_icon.set_from_icon_name(DEFAULT_ICON)
+            Gio.File.new_for_path(obj.path).query_info_async('standard::icon', Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_LOW, None, 
+                                                             lambda file, result, file_box=file_box, obj=obj: self.on_icon_found(file, result, file_box, obj))
         file_box.file_name.add_css_class(obj.change[1])
         file_box.file_change.add_css_class(obj.change[2])
 
+    def on_icon_found(self, file, result, file_box, obj):
+        try:
+            obj.icon = file.query_info_finish(result).get_icon().get_names()[0]
+        except GLib.Error:
+            obj.icon = DEFAULT_ICON
+        if file_box.obj is obj: #the row might have been reused for something else by now
+            file_box.file_icon.set_from_icon_name(obj.icon)
+
     def on_drag_prepare(self, event, x, y):
         widget = event.get_widget()
         gfile = Gio.File.new_for_path(widget.get_item().path)
@@ -266,6 +449,81 @@ class FileBrowser(Gtk.ScrolledWindow):
         event.set_icon(icon, 0, 0)
 
 
+def get_image_key(path, width, height):
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size, width, height)
+
+def get_diff_key(path1, path2):
+    #A file that changes gets a new key, so its old diff is never shown and just ages out of the cache
+    st1 = os.stat(path1)
+    st2 = os.stat(path2)
+    return (path1, st1.st_size, st1.st_mtime_ns, path2, st2.st_size, st2.st_mtime_ns)
+
+def sniff_file(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return UNKNOWN_FILE_TYPE
+    return sniff_file_start(path, st.st_size, st.st_mtime_ns)
+
+@functools.lru_cache(maxsize=SNIFF_CACHE_SIZE)
+def sniff_file_start(path, size, mtime_ns):
+    #Returns (content type, MIME type, text encoding or None); only the start of the file is read, so a wrong guess about a huge file costs a few KB
+    try:
+        with open(path, 'rb') as file:
+            data = file.read(SNIFF_SIZE)
+    except OSError:
+        return UNKNOWN_FILE_TYPE
+    if not data:
+        #Would sniff as application/x-zerosize; an empty file is shown as empty text, also against the text it used to hold
+        return "text/plain", "text/plain", "utf-8"
+    content_type, uncertain = Gio.content_type_guess(path, data)
+    encoding = detect_encoding(data) if Gio.content_type_is_a(content_type, "text/plain") else None
+    return content_type, Gio.content_type_get_mime_type(content_type) or UNKNOWN_FILE_TYPE[1], encoding
+
+class PreviewCache:
+    #Recently shown previews (decoded images and finished diffs), dropping the least recently used once they take up more than max_bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, cost):
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (value, cost)
+            self.size += cost
+            while self.size > self.max_bytes:
+                key, (old, old_cost) = self.entries.popitem(last=False)
+                self.size -= old_cost
+
+def decode_image(key, cache):
+    #Runs in a worker; decodes straight to the size the image will be shown at, never larger than the image itself
+    path, mtime, size, width, height = key
+    try:
+        info, image_width, image_height = GdkPixbuf.Pixbuf.get_file_info(path)
+        if info is None:
+            return None
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, min(width, image_width), min(height, image_height), True)
+        pixbuf = pixbuf.apply_embedded_orientation() or pixbuf
+    except GLib.Error:
+        return None
+    texture = Gdk.Texture.new_for_pixbuf(pixbuf)
+    cache.put(key, texture, texture.get_width()*texture.get_height()*4)
+    return texture
+
 class FileViewer(Gtk.ScrolledWindow):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -274,8 +532,18 @@ class FileViewer(Gtk.ScrolledWindow):
         self.display_stte = 0
         self.top_image_shown = False
         self.bottom_image_shown = False
-        self.image_formats = self.get_supported_image_formats()
+        self._image_formats = None
         self.open_files = []
+        self.diff_cancellable = None
+        self.line_files = []
+        self.hunks = []
+        self.hunk_pos = 0
+        self.line_pos = 0
+        self.line_tag = None
+        self.preview_cache = PreviewCache(gio_settings.get_int("preview-cache-size")*1024*1024)
+        self.preview_pool = None
+        self.preview_jobs = {}
+        self.shown_images = {}
 
         self.set_vexpand(True)
         self.set_hexpand(True)
@@ -324,6 +592,8 @@ class FileViewer(Gtk.ScrolledWindow):
 
         self.addition = buffer.create_tag("addition")
         self.removal = buffer.create_tag("removal")
+        self.hunk = buffer.create_tag("hunk", weight=Pango.Weight.BOLD)
+        gtk_settings = Gtk.Settings.get_default()
         self.on_theme_changed(gtk_settings, None)
 
         gtk_settings.connect("notify::gtk-application-prefer-dark-theme", self.on_theme_changed)
@@ -333,6 +603,13 @@ class FileViewer(Gtk.ScrolledWindow):
             if file:
                 open_file(file)
     
+    @property
+    def image_formats(self):
+        #Asking GdkPixbuf for its loaders is slow, so only do it once an image might be shown
+        if self._image_formats is None:
+            self._image_formats = set(self.get_supported_image_formats())
+        return self._image_formats
+
     def get_supported_image_formats(self):
         supported_formats = GdkPixbuf.Pixbuf.get_formats()
         supported_mime_types = [mime_type for format in supported_formats for mime_type in format.get_mime_types()]
@@ -343,10 +620,12 @@ class FileViewer(Gtk.ScrolledWindow):
             new_style_scheme = self.style_manager.get_scheme("Adwaita-dark")
             self.addition.set_property("background", "#244a2d")
             self.removal.set_property("background", "#54001f")
+            self.hunk.set_property("foreground", "#99c1f1")
         else:
             new_style_scheme = self.style_manager.get_scheme("Adwaita")
             self.addition.set_property("background", "#ccebd3")
             self.removal.set_property("background", "#ffdedf")
+            self.hunk.set_property("foreground", "#1c71d8")
         
         if new_style_scheme != self.style_scheme:
             self.style_scheme = new_style_scheme
@@ -375,67 +654,417 @@ class FileViewer(Gtk.ScrolledWindow):
                 self.image_view.append(self.bottom_image_box)
                 self.bottom_image_shown = True
 
+    def get_image_size(self):
+        #Each picture gets the full width and half the height of the viewer
+        scale = self.get_scale_factor()
+        width = self.get_width()*scale or 1024
+        height = self.get_height()*scale//2 or 1024
+        return -(-width//IMAGE_SIZE_STEP)*IMAGE_SIZE_STEP, -(-height//IMAGE_SIZE_STEP)*IMAGE_SIZE_STEP
+
+    def submit_preview(self, key, function, *args):
+        job = self.preview_jobs.get(key)
+        if job is None or job.cancelled():
+            if self.preview_pool is None:
+                self.preview_pool = ThreadPoolExecutor(PREVIEW_WORKERS)
+            self.preview_jobs[key] = job = self.preview_pool.submit(profiled(function, "diff"), *args)
+            job.add_done_callback(lambda job: GLib.idle_add(self.forget_preview_job, key, job))
+        return job
+
+    def forget_preview_job(self, key, job):
+        if self.preview_jobs.get(key) is job:
+            del self.preview_jobs[key]
+
+    def cancel_preview_jobs(self):
+        #Previews nobody is waiting for any more; ones already being worked on still end up in the cache
+        for job in self.preview_jobs.values():
+            job.cancel()
+
+    def show_image(self, picture, path):
+        try:
+            key = get_image_key(path, *self.get_image_size())
+        except OSError:
+            picture.set_paintable(None)
+            return
+        self.shown_images[picture] = key
+        texture = self.preview_cache.get(key)
+        picture.set_paintable(texture)
+        if texture is None:
+            self.submit_preview(key, decode_image, key, self.preview_cache).add_done_callback(lambda job: GLib.idle_add(profiled(self.on_image_loaded, "diff", True), picture, key, job))
+
+    def on_image_loaded(self, picture, key, job):
+        if self.shown_images.get(picture) == key and not job.cancelled():
+            picture.set_paintable(job.result())
+
+    def prefetch_diff(self, path1, path2):
+        kind, content_type, encodings = self.get_view_kind(path1, path2)
+        if kind == "image":
+            size = self.get_image_size()
+            for path in (path1, path2):
+                if path:
+                    try:
+                        key = get_image_key(path, *size)
+                    except OSError:
+                        continue
+                    if self.preview_cache.get(key) is None:
+                        self.submit_preview(key, decode_image, key, self.preview_cache)
+        elif kind in ("text", "binary") and path1 and path2:
+            try:
+                key = get_diff_key(path1, path2)
+            except OSError:
+                return
+            #Big files are left until they are actually shown
+            if max(key[1], key[4]) > gio_settings.get_int("diff-large-file-size")*1024*1024:
+                return
+            if self.preview_cache.get(key) is None:
+                encodings = encodings if kind == "text" else None
+                self.submit_preview(key, self.compute_payload, path1, path2, encodings, key, None, self.get_diff_options())
+
+    def get_view_kind(self, path1, path2):
+        #Which view suits these files, going by what the start of each file holds rather than its name
+        types = [sniff_file(path) for path in (path1, path2) if path]
+        content_type, mime_type, encoding = types[0]
+        encodings = [file_type[2] for file_type in types]
+        if mime_type in self.image_formats:
+            kind = "image"
+        elif all(encodings):
+            kind = "text"
+        elif path1 and path2:
+            kind = "binary"
+        else:
+            kind = None
+        return kind, content_type, encodings
+
+    def cancel_diff(self):
+        if self.diff_cancellable:
+            self.diff_cancellable.cancel()
+            self.diff_cancellable = None
+        for file in self.line_files:
+            file.close()
+        self.line_files = []
+        self.hunks = []
+
+    def get_diff_options(self):
+        return {"max_edits": gio_settings.get_int("diff-max-edits"),
+                "timeout": gio_settings.get_int("diff-timeout")/1000,
+                "count_blocks": gio_settings.get_boolean("binary-count-blocks")}
+
+    def start_diff(self, path1, path2, encodings=None):
+        self.buffer.set_text('')
+        self.diff_cancellable = cancellable = Gio.Cancellable()
+        options = self.get_diff_options()
+        try:
+            key = get_diff_key(path1, path2)
+        except OSError:
+            key = None
+        #Big files only get their changed lines shown, read straight from the files
+        large_size = gio_settings.get_int("diff-large-file-size")*1024*1024
+        hunks_only = (encodings and key is not None and all(is_line_encoding(encoding) for encoding in encodings)
+                      and (gio_settings.get_boolean("diff-unified") or max(key[1], key[4]) > large_size))
+        self.code_view.set_show_line_numbers(not hunks_only)
+
+        if hunks_only:
+            target = lambda: self.compute_hunks(path1, path2, encodings, cancellable, options)
+        else:
+            payload = self.preview_cache.get(key) if key else None
+            if payload is not None:
+                self.render_payload(payload, cancellable)
+                return
+            job = self.preview_jobs.get(key)
+            if job is not None and not job.cancelled():
+                #Already being worked out in the background for a neighbouring row
+                job.add_done_callback(lambda job: GLib.idle_add(profiled(self.on_payload_loaded, "diff", True), job, cancellable))
+                return
+            target = lambda: self.compute_diff(path1, path2, encodings, key, cancellable, options)
+        thread = threading.Thread(target=profiled(target, "diff"), daemon=True)
+        thread.start()
+
+    def compute_hunks(self, path1, path2, encodings, cancellable, options):
+        def check():
+            if cancellable.is_cancelled():
+                raise DiffCancelled()
+
+        files = []
+        try:
+            files.append(LineFile(path1, check, encodings[0]))
+            files.append(LineFile(path2, check, encodings[1]))
+            ops = diff_lines(files[0].hashes, files[1].hashes, max_edits=options["max_edits"], timeout=options["timeout"], cancellable=cancellable, page=DIFF_PAGE)
+            GLib.idle_add(profiled(lambda: self.render_hunks(files, ops, cancellable), "diff", True))
+            return
+        except DiffCancelled:
+            pass
+        except OSError:
+            GLib.idle_add(profiled(lambda: self.show_useless_view(cancellable), "diff", True))
+        for file in files:
+            file.close()
+
+    def render_hunks(self, files, ops, cancellable):
+        if cancellable is not self.diff_cancellable:
+            for file in files:
+                file.close()
+            return
+        self.diff_cancellable = None
+        self.line_files = files
+        self.hunks = list(group_hunks(ops, gio_settings.get_int("diff-context-lines")))
+        self.hunk_pos = 0
+        self.buffer.set_text('')
+        self.show_more_hunks()
+
+    def show_more_hunks(self, button=None, anchor=None):
+        buffer = self.buffer
+        buffer.begin_irreversible_action()
+        if anchor:
+            self.remove_anchor(anchor)
+
+        text = []
+        ranges = []
+        line = buffer.get_line_count() - 1
+        shown = 0
+        while self.hunk_pos < len(self.hunks) and shown < HUNK_PAGE:
+            item = self.hunks[self.hunk_pos]
+            self.hunk_pos += 1
+            if isinstance(item, tuple):
+                self.append_buffer_text("".join(text), ranges)
+                text = []
+                ranges = []
+                self.add_expander(self.get_gap_label(item[2] - item[1]), self.expand_gap, list(item[1:]))
+                line = buffer.get_line_count() - 1
+                continue
+
+            text.append(hunk_header(item) + "\n")
+            ranges.append(("hunk", line, line + 1))
+            line += 1
+            for tag, i1, i2, j1, j2 in item:
+                lines = self.line_files[1].lines(j1, j2) if tag == "insert" else self.line_files[0].lines(i1, i2)
+                prefix = DIFF_PREFIXES[tag]
+                text.append("".join(prefix + content + "\n" for content in lines))
+                if tag != "equal":
+                    ranges.append((tag, line, line + len(lines)))
+                line += len(lines)
+            shown += 1
+        self.append_buffer_text("".join(text), ranges)
+
+        if self.hunk_pos < len(self.hunks):
+            self.add_expander("Show more changes", self.show_more_hunks)
+        buffer.end_irreversible_action()
+
+    def append_buffer_text(self, text, ranges):
+        buffer = self.buffer
+        buffer.insert(buffer.get_end_iter(), text)
+        for tag, start, end in ranges:
+            found, start_iter = buffer.get_iter_at_line(start)
+            found, end_iter = buffer.get_iter_at_line(end)
+            buffer.apply_tag_by_name(DIFF_TAGS[tag], start_iter, end_iter)
+
+    def add_expander(self, label, callback, *args):
+        #A button inside the text, standing in for lines that are not shown yet
+        buffer = self.buffer
+        anchor = buffer.create_child_anchor(buffer.get_end_iter())
+        buffer.insert(buffer.get_end_iter(), "\n")
+        button = Gtk.Button(label=label)
+        button.add_css_class("flat")
+        button.connect("clicked", lambda button: callback(button, anchor, *args))
+        self.code_view.add_child_at_anchor(button, anchor)
+
+    def remove_anchor(self, anchor):
+        start = self.buffer.get_iter_at_child_anchor(anchor)
+        end = start.copy()
+        end.forward_chars(2)
+        self.buffer.delete(start, end)
+
+    def get_gap_label(self, count):
+        return f"Show {count} unchanged line{'s' if count != 1 else ''}"
+
+    def expand_gap(self, button, anchor, gap):
+        i1, i2, j1, j2 = gap
+        count = min(EXPAND_LINES, i2 - i1)
+        lines = self.line_files[0].lines(i1, i1 + count)
+        buffer = self.buffer
+        buffer.begin_irreversible_action()
+        buffer.insert(buffer.get_iter_at_child_anchor(anchor), "".join("  " + content + "\n" for content in lines))
+        gap[0] += count
+        gap[2] += count
+        if gap[0] < i2:
+            button.set_label(self.get_gap_label(i2 - gap[0]))
+        else:
+            self.remove_anchor(anchor)
+        buffer.end_irreversible_action()
+
+    def start_text(self, path, encoding, tag):
+        #A file only on one side is read and decoded in the background too, then shown like a finished diff
+        self.buffer.set_text('')
+        self.diff_cancellable = cancellable = Gio.Cancellable()
+        thread = threading.Thread(target=profiled(lambda: self.compute_text(path, encoding, tag, cancellable), "diff"), daemon=True)
+        thread.start()
+
+    def compute_text(self, path, encoding, tag, cancellable):
+        try:
+            with open(path, 'r', encoding=encoding) as file:
+                content = file.read()
+        except (OSError, UnicodeDecodeError):
+            GLib.idle_add(profiled(lambda: self.show_useless_view(cancellable), "diff", True))
+            return
+        payload = (False, content, [(tag, 0, content.count('\n') + 1)])
+        GLib.idle_add(profiled(lambda: self.render_payload(payload, cancellable), "diff", True))
+
+    def start_lines(self, path, encoding, tag):
+        #Big files only on one side are indexed in the background and shown a page at a time, like the hunks of big diffs
+        self.buffer.set_text('')
+        self.diff_cancellable = cancellable = Gio.Cancellable()
+        thread = threading.Thread(target=profiled(lambda: self.compute_lines(path, encoding, tag, cancellable), "diff"), daemon=True)
+        thread.start()
+
+    def compute_lines(self, path, encoding, tag, cancellable):
+        def check():
+            if cancellable.is_cancelled():
+                raise DiffCancelled()
+
+        try:
+            file = LineFile(path, check, encoding)
+        except DiffCancelled:
+            return
+        except OSError:
+            GLib.idle_add(profiled(lambda: self.show_useless_view(cancellable), "diff", True))
+            return
+        GLib.idle_add(profiled(lambda: self.render_lines(file, tag, cancellable), "diff", True))
+
+    def render_lines(self, file, tag, cancellable):
+        if cancellable is not self.diff_cancellable:
+            file.close()
+            return
+        self.diff_cancellable = None
+        self.line_files = [file]
+        self.line_tag = tag
+        self.line_pos = 0
+        self.buffer.set_text('')
+        self.show_more_lines()
+
+    def show_more_lines(self, button=None, anchor=None):
+        file = self.line_files[0]
+        buffer = self.buffer
+        buffer.begin_irreversible_action()
+        if anchor:
+            self.remove_anchor(anchor)
+
+        line = buffer.get_line_count() - 1
+        end = min(len(file), self.line_pos + LINE_PAGE)
+        lines = file.lines(self.line_pos, end)
+        self.append_buffer_text("".join(content + "\n" for content in lines), [(self.line_tag, line, line + len(lines))])
+        self.line_pos = end
+
+        if end < len(file):
+            self.add_expander(f"Show more lines ({len(file) - end} left)", self.show_more_lines)
+        buffer.end_irreversible_action()
+
+    def compute_payload(self, path1, path2, encodings, key, cancellable, options):
+        #Runs in a worker; returns (binary, text, ranges) and keeps it so coming back to these files is instant.
+        #Files without encodings are compared byte for byte
+        def check():
+            if cancellable and cancellable.is_cancelled():
+                raise DiffCancelled()
+
+        payload = None
+        if encodings:
+            try:
+                with open(path1, 'r', encoding=encodings[0]) as file:
+                    content1 = file.read()
+                with open(path2, 'r', encoding=encodings[1]) as file:
+                    content2 = file.read()
+                payload = (False,) + diff_text(content1.splitlines(), content2.splitlines(), max_edits=options["max_edits"], timeout=options["timeout"], cancellable=cancellable)
+            except UnicodeDecodeError:
+                pass
+        if payload is None:
+            result = compare_binary(path1, path2, count_blocks=options["count_blocks"], check=check)
+            payload = (True,) + binary_diff_text(result)
+        if key:
+            self.preview_cache.put(key, payload, sys.getsizeof(payload[1]) + 64*len(payload[2]))
+        return payload
+
+    def compute_diff(self, path1, path2, encodings, key, cancellable, options):
+        try:
+            payload = self.compute_payload(path1, path2, encodings, key, cancellable, options)
+        except DiffCancelled:
+            return
+        except OSError:
+            GLib.idle_add(profiled(lambda: self.show_useless_view(cancellable), "diff", True))
+            return
+        GLib.idle_add(profiled(lambda: self.render_payload(payload, cancellable), "diff", True))
+
+    def on_payload_loaded(self, job, cancellable):
+        if job.cancelled() or job.exception():
+            self.show_useless_view(cancellable)
+        else:
+            self.render_payload(job.result(), cancellable)
+
+    def show_useless_view(self, cancellable=None):
+        if cancellable is not None and cancellable is not self.diff_cancellable:
+            return
+        if self.get_child() != self.useless_view:
+            self.set_child(self.useless_view)
+
+    def render_payload(self, payload, cancellable):
+        if cancellable is not self.diff_cancellable: #another file was selected in the meantime
+            return
+        self.diff_cancellable = None
+        binary, text, ranges = payload
+        if binary:
+            if self.get_child() != self.code_view:
+                self.set_child(self.code_view)
+            self.buffer.set_language(None)
+            self.code_view.set_show_line_numbers(False)
+        self.set_buffer_text(text, ranges)
+
+    def set_buffer_text(self, text, ranges):
+        #One insert and one tag per block instead of one insert per line; nothing here needs to be undoable
+        buffer = self.buffer
+        buffer.begin_irreversible_action()
+        buffer.set_text(text)
+        for tag, start, end in ranges:
+            found, start_iter = buffer.get_iter_at_line(start)
+            found, end_iter = buffer.get_iter_at_line(end)
+            if not found:
+                end_iter = buffer.get_end_iter()
+            buffer.apply_tag_by_name(DIFF_TAGS[tag], start_iter, end_iter)
+        buffer.end_irreversible_action()
+
     def show_diff(self, path1, path2):
+        self.cancel_diff()
+        self.cancel_preview_jobs()
+        self.shown_images.clear()
         self.open_files = [path1, path2]
         try:
-            if path1:
-                mime_type, encoding = mimetypes.guess_type(path1)
-            else:
-                mime_type, encoding = mimetypes.guess_type(path2)
-            if not mime_type: mime_type = "text/unknown"
+            kind, content_type, encodings = self.get_view_kind(path1, path2)
 
-            if mime_type in self.image_formats:
+            if kind == "image":
                 if self.get_child() != self.image_view:
                     self.set_child(self.image_view)
                 if path1:
-                    self.top_image.set_filename(path1)
+                    self.show_image(self.top_image, path1)
                 if path2:
-                    self.bottom_image.set_filename(path2)
+                    self.show_image(self.bottom_image, path2)
                 self.manage_image_view(path1, path2)
                 
-            elif mime_type.startswith("text/"):
+            elif kind == "text":
                 if self.get_child() != self.code_view:
                     self.set_child(self.code_view)
+                self.code_view.set_show_line_numbers(True)
 
                 if path1 and path2:
-                    language = self.language_manager.guess_language(path1, None)
-                    self.buffer.set_language(language)
-
-                    with open(path1, 'r') as file:
-                        content1 = file.read()
-                    with open(path2, 'r') as file:
-                        content2 = file.read()
-                    diff = difflib.Differ().compare(content1.splitlines(), content2.splitlines())
-
-                    self.buffer.set_text('')
-
-                    for line in diff:
-                        if line.startswith('+'):
-                            self.buffer.insert_with_tags_by_name(self.buffer.get_end_iter(), line + '\n', "addition")
-                        elif line.startswith('-'):
-                            self.buffer.insert_with_tags_by_name(self.buffer.get_end_iter(), line + '\n', "removal")
-                        else:
-                            self.buffer.insert(self.buffer.get_end_iter(), line + '\n')
-                elif path1:
-                    language = self.language_manager.guess_language(path1, None)
+                    language = self.language_manager.guess_language(path1, content_type)
                     self.buffer.set_language(language)
-
-                    with open(path1, 'r') as file:
-                        content1 = file.read()
-
-                    self.buffer.set_text('')
-
-                    self.buffer.insert_with_tags_by_name(self.buffer.get_end_iter(), content1, "addition")
-                elif path2:
-                    language = self.language_manager.guess_language(path2, None)
+                    self.start_diff(path1, path2, encodings)
+                else:
+                    path, tag = (path1, 'insert') if path1 else (path2, 'delete')
+                    language = self.language_manager.guess_language(path, content_type)
                     self.buffer.set_language(language)
 
-                    with open(path2, 'r') as file:
-                        content2 = file.read()
-
-                    self.buffer.set_text('')
-
-                    self.buffer.insert_with_tags_by_name(self.buffer.get_end_iter(), content2, "removal")
+                    if os.path.getsize(path) > gio_settings.get_int("diff-large-file-size")*1024*1024 and is_line_encoding(encodings[0]):
+                        self.start_lines(path, encodings[0], tag)
+                    else:
+                        self.start_text(path, encodings[0], tag)
+            elif kind == "binary":
+                if self.get_child() != self.code_view:
+                    self.set_child(self.code_view)
+                self.start_diff(path1, path2)
             else:
                 if self.get_child() != self.useless_view:
                     self.set_child(self.useless_view)
@@ -444,18 +1073,80 @@ class FileViewer(Gtk.ScrolledWindow):
                 self.set_child(self.useless_view)
             
 class DataObject(GObject.GObject):
-    def __init__(self, name: str, path:str, icon: str, children=None, change="", alternate_path=None):
+    #A row of the file browser; the data itself lives in a ResultTree
+    def __init__(self, tree: ResultTree, index: int):
         super(DataObject, self).__init__()
 
-        self.name = name
-        self.path = path
-        self.alternate_path = alternate_path
-        self.icon = icon
-        self.children = children
-        self.change = change
+        self.tree = tree
+        self.index = index
 
         self._store = None
-        self._is_visible = True
+        self._child_store = None
+        self._filled = False
+
+    @property
+    def name(self):
+        return self.tree.get_name(self.index)
+
+    @property
+    def path(self):
+        return self.tree.path(self.index)
+
+    @property
+    def alternate_path(self):
+        if self.tree.change[self.index] == UNCHANGED:
+            return None
+        return self.tree.alternate_path(self.index)
+
+    @property
+    def moved_from(self):
+        return self.tree.moved.get(self.index)
+
+    @property
+    def icon(self):
+        return self.tree.get_icon(self.index)
+
+    @icon.setter
+    def icon(self, icon):
+        self.tree.set_icon(self.index, icon)
+
+    @property
+    def change(self):
+        return CHANGES[self.tree.change[self.index]]
+
+    @property
+    def is_folder(self):
+        return self.tree.change[self.index] == DIRECTORY
+
+    @property
+    def _is_visible(self):
+        return bool(self.tree.visible[self.index])
+
+    @_is_visible.setter
+    def _is_visible(self, visible):
+        self.tree.visible[self.index] = visible
+
+class ScanJob:
+    #Everything that belongs to one run of the scanner; a newer job replaces it in MainWindow.scan_job
+    def __init__(self, tree):
+        self.tree = tree
+        self.cancellable = Gio.Cancellable()
+        self.dirs = {"": tree.ROOT}
+        self.show_all = gio_settings.get_boolean("show-all")
+        self.engine = None
+
+        #Folders to watch once the scan is done: those with differences first, then any others
+        self.watch_limit = gio_settings.get_int("watch-limit") if gio_settings.get_boolean("watch-changes") else 0
+        system_limit = get_watch_limit()
+        if system_limit is not None:
+            self.watch_limit = min(self.watch_limit, system_limit)
+        self.changed_dirs = []
+        self.other_dirs = []
+
+        #Entries only on one side, relpath: (index, is_dir), to look for moved files in once the scan is done
+        self.detect_moves = gio_settings.get_boolean("detect-moves")
+        self.left_only = {}
+        self.right_only = {}
 
 class MainWindow(Gtk.ApplicationWindow):
     def __init__(self, application, *args, **kwargs):
@@ -468,6 +1159,21 @@ class MainWindow(Gtk.ApplicationWindow):
         self.sidebar_should_show = False
         self.searching = False
 
+        self.pending_results = []
+        self.pending_lock = threading.Lock()
+        self.scan_status = None
+        self.flush_source = None
+        self.scan_job = None
+        self.auto_scan_source = None
+
+        self.live_job = None
+        self.monitors = []
+        self.pending_rechecks = set()
+        self.recheck_source = None
+        self.rechecking = False
+        self.copy_engines = []
+        self.copy_source = None
+
         self.set_icon_name(ICON)
 
         self.master_container = master_container = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, vexpand=True)
@@ -587,7 +1293,8 @@ class MainWindow(Gtk.ApplicationWindow):
         self.file_browser = file_browser = FileBrowser()
         self.no_results_container = no_results_container = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, valign=Gtk.Align.CENTER, vexpand=True)
         self.no_results_page = no_results_page = Adw.StatusPage()
-        self.code_viewer = code_viewer = FileViewer()
+        self._code_viewer = None #created the first time a file is shown
+        self.viewer_files = None
 
         gio_settings.bind("sidebar-width", content_pane, "position", Gio.SettingsBindFlags.DEFAULT)
         no_results_page.set_icon_name("search-symbolic")
@@ -626,48 +1333,100 @@ class MainWindow(Gtk.ApplicationWindow):
         selected = self.file_browser.right_clicked_item
         if selected: 
             threading.Thread(target=lambda path=selected.path: open_file(path)).start()
-            if selected.change == CHANGE_CHANGED or selected.change == CHANGE_UNKNOWN:
+            if selected.change in (CHANGE_CHANGED, CHANGE_UNKNOWN, CHANGE_MOVED):
                 threading.Thread(target=lambda path=selected.alternate_path: open_file(path)).start()    
 
     def show_file_system(self, *args):
         selected = self.file_browser.right_clicked_item
         if selected: 
             threading.Thread(target=lambda path=selected.path: show_file(path)).start()
-            if selected.change == CHANGE_CHANGED or selected.change == CHANGE_UNKNOWN:
+            if selected.change in (CHANGE_CHANGED, CHANGE_UNKNOWN, CHANGE_MOVED):
                 threading.Thread(target=lambda path=selected.alternate_path: show_file(path)).start()  
 
     def on_response(self, dialog, response_id):
         dialog.close()
-        if len(threading.enumerate()) == 1:
-            self.master_container.append(self.footer_bar)
-            self.spinner.start()
-        thread = threading.Thread(target=lambda dialog=dialog, response_id=response_id: self.continue_response(dialog, response_id), daemon=True)
-        thread.start()
-        
-    def continue_response(self, dialog, response_id):
         selected = self.file_browser.right_clicked_item
-        prev = self.bottom_label.get_label()
-        
-        if response_id == Gtk.ResponseType.YES or response_id == 1:
-            GLib.idle_add(lambda path=selected.path: self.bottom_label.set_label("Resolving " + path))
-            self.file_browser.remove_item(selected)
-            if os.path.isfile(selected.path):
-                shutil.copy2(selected.path, os.path.dirname(selected.alternate_path))
-            else:
-                shutil.copytree(selected.path, selected.alternate_path)
+        if selected.change == CHANGE_MOVED:
+            #Moved entries are renamed on one side to match the other, nothing is copied
+            tree = selected.tree
+            relpath = tree.relpath(selected.index)
+            if response_id == 1:
+                self.start_copy(selected, selected.alternate_path, os.path.join(tree.right, relpath), move=True)
+            elif response_id == 2:
+                self.start_copy(selected, selected.path, os.path.join(tree.left, selected.moved_from), move=True)
+        elif response_id == Gtk.ResponseType.YES or response_id == 1:
+            self.start_copy(selected, selected.path, selected.alternate_path)
         elif response_id == 2:
-            GLib.idle_add(lambda path=selected.alternate_path: self.bottom_label.set_label("Resolving " + path))
-            self.file_browser.remove_item(selected)
-            if os.path.isfile(selected.alternate_path):
-                shutil.copy2(selected.alternate_path, os.path.dirname(selected.path))
-            else:
-                shutil.copytree(selected.alternate_path, selected.path)
+            self.start_copy(selected, selected.alternate_path, selected.path)
+
+    def start_copy(self, item, source, destination, move=False):
+        delta_min_size = gio_settings.get_int("delta-min-size")*1024*1024 if gio_settings.get_boolean("delta-copy") else None
+        engine = CopyEngine(gio_settings.get_int("copy-workers"), Gio.Cancellable(), delta_min_size, gio_settings.get_boolean("copy-verify"))
+        self.copy_engines.append(engine)
+        if self.footer_bar.get_parent() is None:
+            self.master_container.append(self.footer_bar)
+        self.spinner.start()
+        self.copy_cancel_button.set_visible(True)
+        if self.copy_source is None:
+            self.copy_source = GLib.timeout_add(int(STATUS_INTERVAL*1000), self.on_copy_tick)
+        if not self.searching:
+            self.bottom_label.set_label("Resolving " + source)
+        thread = threading.Thread(target=lambda: self.run_copy(engine, item, source, destination, move), daemon=True)
+        thread.start()
 
-        if len(threading.enumerate()) == 2:
+    def run_copy(self, engine, item, source, destination, move=False):
+        error = None
+        try:
+            if move:
+                engine.move(source, destination)
+            else:
+                engine.copy(source, destination)
+        except CopyCancelled:
+            error = "Copying cancelled; resolve again to carry on where it stopped"
+        except OSError as e:
+            error = f"Could not {'move' if move else 'copy'} {e.filename or source}: {e.strerror}"
+        GLib.idle_add(lambda: self.finish_copy(engine, item, error))
+
+    def finish_copy(self, engine, item, error):
+        self.copy_engines.remove(engine)
+        #A scan may have replaced the tree while copying; its indices mean other entries there
+        if error is None and item.tree is self.file_browser.tree:
+            self.file_browser.remove_item(item)
+        if not self.copy_engines:
+            GLib.source_remove(self.copy_source)
+            self.copy_source = None
+            self.copy_cancel_button.set_visible(False)
+            if not self.searching:
+                if error:
+                    #Leave the footer up so the message can be read; the next scan takes it down
+                    self.spinner.stop()
+                else:
+                    self.hide_footer_bar()
+        if error and not self.searching:
+            self.bottom_label.set_label(error)
+
+    def on_copy_tick(self):
+        if not self.searching:
+            files_done = files_total = bytes_done = bytes_total = 0
+            for engine in self.copy_engines:
+                progress = engine.progress
+                files_done += progress.files_done
+                files_total += progress.files_total
+                bytes_done += progress.bytes_done
+                bytes_total += progress.bytes_total
+            self.bottom_label.set_label(f"Copying {files_done} of {files_total} files ({GLib.format_size(bytes_done)} of {GLib.format_size(bytes_total)})")
+        return True
+
+    def cancel_copies(self, *args):
+        for engine in self.copy_engines:
+            engine.cancellable.cancel()
+
+    def hide_footer_bar(self):
+        if self.copy_engines: #still needed to show copy progress
+            return
+        if self.footer_bar.get_parent() is not None:
             self.master_container.remove(self.footer_bar)
-            self.spinner.stop()
-        if self.searching:
-            GLib.idle_add(lambda prev=prev: self.bottom_label.set_label(prev))            
+        self.spinner.stop()
 
     def simplify_path(self, folder, path):
         if len(path) > 1:
@@ -714,6 +1473,13 @@ class MainWindow(Gtk.ApplicationWindow):
             dialog.add_button("Cancel", Gtk.ResponseType.CANCEL)
             dialog.add_button(f"Copy to {folder1}", 2)
             dialog.add_button(f"Copy to {folder2}", 1)
+        elif selected.change == CHANGE_MOVED:
+            tree = selected.tree
+            relpath = tree.relpath(selected.index)
+            dialog.set_property("secondary_text", f"{selected.name} was moved or renamed. It is {relpath} in {tree.left}, but {selected.moved_from} in {tree.right}.")
+            dialog.add_button("Cancel", Gtk.ResponseType.CANCEL)
+            dialog.add_button(f"Rename in {os.path.basename(tree.left)}", 2)
+            dialog.add_button(f"Rename in {os.path.basename(tree.right)}", 1)
         elif selected.change == CHANGE_LEFT:
             alternate_path = os.path.dirname(selected.alternate_path)
             dialog.set_property("secondary_text", f"The file {selected.path} is not in the folder {alternate_path}. Copy over?")
@@ -733,10 +1499,17 @@ class MainWindow(Gtk.ApplicationWindow):
         footer_bar = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, halign=Gtk.Align.FILL, spacing=10)
         footer_bar_box = Gtk.Box(hexpand=True, halign=Gtk.Align.END, spacing=10)
         self.bottom_label = bottom_label = Gtk.Label()
+        self.stats_label = stats_label = Gtk.Label(visible=False)
+        stats_label.add_css_class("dim-label")
         self.spinner = spinner = Gtk.Spinner()
+        self.copy_cancel_button = copy_cancel_button = Gtk.Button(icon_name="process-stop-symbolic", tooltip_text="Stop copying", visible=False)
+        copy_cancel_button.add_css_class("flat")
+        copy_cancel_button.connect("clicked", self.cancel_copies)
 
         footer_bar.append(bottom_label)
         footer_bar.append(footer_bar_box)
+        footer_bar_box.append(stats_label)
+        footer_bar_box.append(copy_cancel_button)
         footer_bar_box.append(spinner)
 
         footer_bar.add_css_class("bottom_bar")
@@ -749,42 +1522,147 @@ class MainWindow(Gtk.ApplicationWindow):
     def quit_app(self, *args):
         self.application.quit()
 
+    @property
+    def code_viewer(self):
+        if self._code_viewer is None:
+            load_viewer_modules()
+            self._code_viewer = FileViewer()
+        return self._code_viewer
+
+    def show_viewer_files(self):
+        if self.viewer_files:
+            self.code_viewer.show_diff(*self.viewer_files)
+            self.viewer_files = None
+
     def show_sidebar(self, button):
         if button.get_active():
             if self.sidebar_should_show:
+                self.show_viewer_files()
                 self.content_pane.set_end_child(self.code_viewer)
             gio_settings.set_boolean("view-files", True)
         else:
             self.content_pane.set_end_child(None)
             gio_settings.set_boolean("view-files", False)
 
+    def get_viewer_files(self, item):
+        path = item.path
+        if item.change == CHANGE_CHANGED or item.change == CHANGE_MOVED:
+            return (path, item.alternate_path)
+        elif item.change == CHANGE_LEFT:
+            return (path, None)
+        elif item.change == CHANGE_RIGHT:
+            return (None, path)
+
+    def prefetch_neighbours(self, position):
+        #Start decoding the rows around the selection so moving through them with the arrow keys does not wait
+        model = self.file_browser.selection.get_model()
+        for neighbour in (position + 1, position - 1):
+            if 0 <= neighbour < model.get_n_items():
+                item = model.get_item(neighbour).get_item()
+                files = self.get_viewer_files(item)
+                if files and not item.is_folder:
+                    self.code_viewer.prefetch_diff(*files)
+
     def on_item_list_selected(self, event, evt):
         selected = event.get_selected_item()
         if selected: 
             path = selected.get_item().path
             if os.path.isfile(path):
-                if selected.get_item().change == CHANGE_CHANGED:
-                    self.code_viewer.show_diff(path, selected.get_item().alternate_path)   
-                elif selected.get_item().change == CHANGE_LEFT:               
-                    self.code_viewer.show_diff(path, None)
-                elif selected.get_item().change == CHANGE_RIGHT:               
-                    self.code_viewer.show_diff(None, path)
+                self.viewer_files = self.get_viewer_files(selected.get_item()) or self.viewer_files
 
                 self.sidebar_should_show = True
                 self.file_viewer_toggle.set_sensitive(True)
+                #While the viewer is hidden the file is only loaded once it is opened again
                 if self.file_viewer_toggle.get_active():
+                    self.show_viewer_files()
                     self.content_pane.set_end_child(self.code_viewer)
+                    self.prefetch_neighbours(event.get_selected())
             else:
                 self.sidebar_should_show = False
                 self.content_pane.set_end_child(None)
                 self.file_viewer_toggle.set_sensitive(False)
 
-    def get_thumbnail_name(self, file_path):
-        file = Gio.File.new_for_path(file_path)
-        name = file.query_info('standard::icon', 0).get_icon().get_names()[0]
-        return name
-    
-    def finish_scan(self, change):
+    def start_result_flushing(self):
+        self.pending_results = []
+        self.scan_status = None
+        self.last_status_time = 0
+        self.flush_stats = [0, 0.0, 0.0, 0.0] #ticks, worst timer lag, worst flush time, total flush time
+        self.last_tick = time.monotonic()
+        self.stats_label.set_label("")
+        self.stats_label.set_visible(True)
+        if self.flush_source is None:
+            self.flush_source = GLib.timeout_add(FLUSH_INTERVAL, profiled(self.on_flush_tick, "scan"))
+
+    def stop_result_flushing(self):
+        self.flush_scan_results()
+        if self.flush_source is not None:
+            GLib.source_remove(self.flush_source)
+            self.flush_source = None
+        self.stats_label.set_visible(False)
+        if DEBUG:
+            ticks, lag, flush, total = self.flush_stats
+            print(f"Scan results: {ticks} flushes, worst main loop lag {lag*1000:.1f} ms, worst flush {flush*1000:.1f} ms", file=sys.stderr)
+
+    def on_flush_tick(self):
+        now = time.monotonic()
+        #How late this tick fired is a good measure of how busy the main loop is
+        self.flush_stats[0] += 1
+        self.flush_stats[1] = max(self.flush_stats[1], now - self.last_tick - FLUSH_INTERVAL/1000)
+        self.last_tick = now
+
+        self.flush_scan_results()
+        flush = time.monotonic() - now
+        self.flush_stats[2] = max(self.flush_stats[2], flush)
+        self.flush_stats[3] += flush
+
+        if self.scan_status and now - self.last_status_time >= STATUS_INTERVAL:
+            self.bottom_label.set_label("Scanning " + self.scan_status)
+            self.update_scan_stats()
+            self.last_status_time = now
+        return GLib.SOURCE_CONTINUE
+
+    def update_scan_stats(self):
+        engine = self.scan_job.engine if self.scan_job else None
+        if engine:
+            stats = engine.stats
+            dirs, files, compared = stats.rates()
+            self.stats_label.set_label(f"{dirs:,.0f} folders/s · {files:,.0f} files/s · {GLib.format_size(int(compared))}/s read · {stats.queue_depth} queued")
+
+    def write_scan_report(self, job, outcome):
+        if not job.engine or not gio_settings.get_boolean("scan-reports"):
+            return
+        ticks, lag, flush, total = self.flush_stats
+        report = job.engine.report()
+        report["outcome"] = outcome
+        report["ui"] = {"flushes": ticks, "worst_lag_ms": round(lag*1000, 1), "worst_flush_ms": round(flush*1000, 1), "flush_seconds": round(total, 3)}
+        try:
+            path = write_report(report)
+        except OSError as error:
+            print("Could not write the scan report:", error)
+            return
+        if DEBUG:
+            print("Scan report written to", path, file=sys.stderr)
+
+    def queue_scan_results(self, job, indices):
+        with self.pending_lock:
+            if job is self.scan_job: #results from a scan that has been replaced are dropped
+                self.pending_results.extend(indices)
+
+    def flush_scan_results(self):
+        with self.pending_lock:
+            results, self.pending_results = self.pending_results, []
+        if results:
+            self.file_browser.add_items(results)
+            if self.no_results: #show the listview now so people don't see the no results page
+                self.content_pane.set_start_child(self.file_browser)
+                self.no_results = False
+
+    def finish_scan(self, job, change):
+        if job is not self.scan_job:
+            return
+        self.scan_job = None
+        self.stop_result_flushing()
+        self.write_scan_report(job, "done")
         if change:
             if self.no_results:
                 self.content_pane.set_start_child(self.file_browser)
@@ -797,97 +1675,297 @@ class MainWindow(Gtk.ApplicationWindow):
                 self.content_pane.set_start_child(self.no_results_container)
                 self.no_results = True
 
-        self.master_container.remove(self.footer_bar)
-        self.spinner.stop()
         self.searching = False
+        self.hide_footer_bar()
+        self.start_watching(job)
     
-    def finish_invalid_scan(self):
+    def finish_invalid_scan(self, job):
+        if job is not self.scan_job:
+            return
+        self.scan_job = None
+        self.stop_result_flushing()
+        self.write_scan_report(job, "error")
         self.content_pane.set_start_child(self.invalid_action_container)
-        self.master_container.remove(self.footer_bar)
-        self.spinner.stop()
         self.searching = False
-
-    def begin_scanning(self):
+        self.hide_footer_bar()
+
+    def open_scan_index(self, left, right):
+        if gio_settings.get_boolean("scan-index"):
+            try:
+                return ScanIndex(left, right)
+            except (OSError, sqlite3.Error) as error:
+                print("Could not open the scan index:", error)
+        return None
+
+    def begin_scanning(self, job):
+        left = job.tree.left
+        right = job.tree.right
+        index = self.open_scan_index(left, right)
+        filters = gio_settings.get_value("scan-filters").unpack()
+        max_size = gio_settings.get_int("compare-max-size")
+        max_age = gio_settings.get_int("compare-max-age")
         try:
-            dcmp = dircmp(self.open_button1.folder, self.open_button2.folder)
-            self.show_all = gio_settings.get_boolean("show-all")
-            change = self.find_changes(dcmp) 
-            GLib.idle_add(lambda x=change: self.finish_scan(x))
-        except FileNotFoundError:
-            GLib.idle_add(self.finish_invalid_scan)
-
-    def add_found_item(self, name, root_path, tree_root, change, child=None, alternate_path=None):
-        file_path = os.path.join(root_path, name)
-        if alternate_path:
-            alternate_path = os.path.join(alternate_path, name)
-        pix = self.get_thumbnail_name(file_path)
-        d2 = DataObject(name, file_path, pix, None, change, alternate_path)
-        if child:
-            child[tree_root].children.append(d2)
-        else:
-            GLib.idle_add(lambda x=d2: self.file_browser.store.append(x))
+            job.engine = engine = ScanEngine(left, right, gio_settings.get_int("scan-workers"), show_all=job.show_all, index=index,
+                                             compare_mode=gio_settings.get_string("compare-mode"), samples=gio_settings.get_int("compare-samples"),
+                                             cancellable=job.cancellable, filters=filters.get("*", []) + filters.get(f"{left}|{right}", []),
+                                             compare_max_size=max_size*1024*1024 if max_size else None,
+                                             compare_max_age=max_age*86400 if max_age else None)
+            if profiler:
+                engine.compare_dir = profiler.wrap(engine.compare_dir, "scan") #runs on the engine's worker threads
+            change = False
+            for dcmp in engine.walk():
+                if self.find_changes(job, dcmp):
+                    change = True
+            if job.left_only and job.right_only:
+                self.scan_status = "for moved files"
+                moves = engine.find_moves([(relpath, entry[1]) for relpath, entry in job.left_only.items()],
+                                          [(relpath, entry[1]) for relpath, entry in job.right_only.items()])
+                if moves:
+                    GLib.idle_add(profiled(lambda: self.apply_moves(job, moves), "scan"))
+            GLib.idle_add(profiled(lambda x=change: self.finish_scan(job, x), "scan", True))
+        except ScanCancelled:
+            pass #whoever cancelled the scan has already started a new one
+        except OSError:
+            GLib.idle_add(profiled(lambda: self.finish_invalid_scan(job), "scan", True))
+        finally:
+            if index:
+                index.close()
+                if job.engine:
+                    job.engine.index = None #the engine is kept for watching, which does not use the index
+
+    def get_scan_parent(self, job, relpath, new):
+        #Directories are only added once something inside them has changed, so create any missing ones now
+        index = job.dirs.get(relpath)
+        if index is None:
+            parent = self.get_scan_parent(job, os.path.dirname(relpath), new)
+            index = job.dirs[relpath] = job.tree.add(parent, os.path.basename(relpath), DIRECTORY, self.get_scan_icon(job, relpath, True))
+            new.append(index)
+        return index
+
+    def add_found_item(self, job, relpath, name, change, is_dir=False):
+        new = []
+        parent = self.get_scan_parent(job, relpath, new)
+        index = job.tree.add(parent, name, change, self.get_scan_icon(job, name, is_dir))
+        new.append(index)
+        self.queue_scan_results(job, new) #a new folder has to arrive together with its first child
+        return index
+
+    def get_scan_icon(self, job, name, is_dir=False):
+        start = time.perf_counter()
+        icon = get_icon_name(name, is_dir)
+        job.engine.stats.add_time("icons", time.perf_counter() - start)
+        return icon
+
+    def find_changes(self, job, dcmp):
+        changed = False
+        relpath = dcmp.relpath
 
-        if self.no_results:
-            self.content_pane.set_start_child(self.file_browser)
-            self.no_results = False
+        if relpath:
+            self.scan_status = dcmp.left
 
-    def find_changes(self, dcmp, content=None):
-        changed = False
-        left = dcmp.left
-        right = dcmp.right
+        if dcmp.has_changes():
+            if len(job.changed_dirs) < job.watch_limit:
+                job.changed_dirs.append(relpath)
+        elif len(job.other_dirs) < job.watch_limit:
+            job.other_dirs.append(relpath)
 
         for name in dcmp.diff_files:
-            self.add_found_item(name, left, left, CHANGE_CHANGED, content, right)
+            self.add_found_item(job, relpath, name, CHANGED)
             changed = True
         for name in dcmp.left_only:
-            self.add_found_item(name, left, left, CHANGE_LEFT, content, right)
+            is_dir = name in dcmp.only_dirs
+            index = self.add_found_item(job, relpath, name, LEFT_ONLY, is_dir)
+            if job.detect_moves:
+                job.left_only[os.path.join(relpath, name)] = (index, is_dir)
             changed = True
         for name in dcmp.right_only:
-            self.add_found_item(name, right, left, CHANGE_RIGHT, content, left)
+            is_dir = name in dcmp.only_dirs
+            index = self.add_found_item(job, relpath, name, RIGHT_ONLY, is_dir)
+            if job.detect_moves:
+                job.right_only[os.path.join(relpath, name)] = (index, is_dir)
             changed = True
-        if self.show_all:
+        if job.show_all:
             for name in dcmp.same_files:
-                self.add_found_item(name, left, left, CHANGE_UNCHANGED, content)
+                self.add_found_item(job, relpath, name, UNCHANGED)
             changed = True
-        
-        for sub_dcmp in dcmp.subdirs.values():
-            file_path = sub_dcmp.left
-            GLib.idle_add(lambda y=file_path: self.bottom_label.set_label("Scanning "+y))
-            pix = self.get_thumbnail_name(file_path)
-            subdir_object = DataObject(os.path.basename(file_path), file_path, pix, [], CHANGE_UNKNOWN, sub_dcmp.right)
-
-            if not content:
-                content_new = {}                    
-                content_new[file_path] = subdir_object
-                cg = self.find_changes(sub_dcmp, content_new)
-                if cg: 
-                    changed = True
-                    if self.no_results: #show the listview now so people don't see the no results page
-                        self.content_pane.set_start_child(self.file_browser)
-                    self.no_results = False
-                    GLib.idle_add(lambda x=subdir_object: self.file_browser.store.append(x))
-            else:
-                content[file_path] = subdir_object
-                cg = self.find_changes(sub_dcmp, content)
-                if cg: 
-                    changed = True
-                    content[left].children.append(subdir_object)
 
         return changed
     
+    def apply_moves(self, job, moves):
+        #Replaces each pair of left-only and right-only entries that hold the same data with one moved entry
+        if job is not self.scan_job:
+            return
+        self.flush_scan_results() #the entries being replaced have to be in the list first
+        tree = job.tree
+        parents = set()
+        for left, right, is_dir in moves:
+            for index in (job.left_only[left][0], job.right_only[right][0]):
+                self.file_browser.remove_index(index)
+                parents.add(tree.parent[index])
+        #Folders are only shown while something inside them is different
+        for parent in parents:
+            while parent != tree.ROOT and tree.visible[parent] and not tree.has_visible_children(parent):
+                job.dirs.pop(tree.relpath(parent), None)
+                self.file_browser.remove_index(parent)
+                parent = tree.parent[parent]
+
+        new = []
+        for left, right, is_dir in moves:
+            parent_relpath, name = os.path.split(left)
+            parent = self.get_scan_parent(job, parent_relpath, new)
+            new.append(tree.add(parent, name, MOVED, get_icon_name(name, is_dir), right))
+        self.file_browser.add_items(new)
+
     def prepare_scan_auto(self, *args):
+        #Both folders often change one after the other, so wait a moment and only scan once
         if gio_settings.get_boolean("auto-update"):
-            self.prepare_scan_manual()
+            if self.auto_scan_source is not None:
+                GLib.source_remove(self.auto_scan_source)
+            self.auto_scan_source = GLib.timeout_add(AUTO_SCAN_DELAY, self.on_auto_scan_timeout)
+
+    def on_auto_scan_timeout(self):
+        self.auto_scan_source = None
+        self.prepare_scan_manual()
+        return GLib.SOURCE_REMOVE
+
+    def start_watching(self, job):
+        if not job.watch_limit:
+            return
+        self.live_job = job
+        for relpath in (job.changed_dirs + job.other_dirs)[:job.watch_limit]:
+            self.watch_folder(relpath)
+
+    def watch_folder(self, relpath):
+        for root in (self.live_job.tree.left, self.live_job.tree.right):
+            try:
+                monitor = Gio.File.new_for_path(os.path.join(root, relpath)).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error:
+                continue
+            monitor.connect("changed", self.on_watched_change, relpath)
+            self.monitors.append(monitor)
+
+    def stop_watching(self):
+        for monitor in self.monitors:
+            monitor.cancel()
+        self.monitors = []
+        self.live_job = None
+        self.pending_rechecks.clear()
+        if self.recheck_source is not None:
+            GLib.source_remove(self.recheck_source)
+            self.recheck_source = None
+
+    def on_watched_change(self, monitor, file, other_file, event_type, relpath):
+        if event_type not in WATCH_EVENTS:
+            return
+        self.pending_rechecks.add(os.path.join(relpath, file.get_basename()))
+        if event_type == Gio.FileMonitorEvent.RENAMED and other_file is not None:
+            self.pending_rechecks.add(os.path.join(relpath, other_file.get_basename()))
+        if self.recheck_source is None:
+            self.recheck_source = GLib.timeout_add(WATCH_DELAY, self.on_recheck_timeout)
+
+    def on_recheck_timeout(self):
+        if self.rechecking: #wait for the previous batch so updates are applied in order
+            return GLib.SOURCE_CONTINUE
+        self.recheck_source = None
+        relpaths, self.pending_rechecks = self.pending_rechecks, set()
+        self.rechecking = True
+        job = self.live_job
+        threading.Thread(target=lambda: self.recheck_entries(job, relpaths), daemon=True).start()
+        return GLib.SOURCE_REMOVE
+
+    def recheck_entries(self, job, relpaths):
+        results = []
+        for relpath in relpaths:
+            try:
+                change, is_dir = job.engine.compare_entry(relpath)
+                results.append((relpath, change, is_dir))
+                if change == DIRECTORY:
+                    #A folder that now exists on both sides, compare what is inside it
+                    for dcmp in job.engine.walk(relpath):
+                        for name in dcmp.diff_files:
+                            results.append((os.path.join(dcmp.relpath, name), CHANGED, False))
+                        for name in dcmp.left_only:
+                            results.append((os.path.join(dcmp.relpath, name), LEFT_ONLY, name in dcmp.only_dirs))
+                        for name in dcmp.right_only:
+                            results.append((os.path.join(dcmp.relpath, name), RIGHT_ONLY, name in dcmp.only_dirs))
+            except OSError:
+                continue
+        GLib.idle_add(lambda: self.apply_live_changes(job, results))
+
+    def find_result(self, job, relpath):
+        index = job.dirs.get(relpath)
+        if index is not None:
+            return index
+        parent = job.dirs.get(os.path.dirname(relpath))
+        if parent is not None:
+            name = os.path.basename(relpath)
+            for child in job.tree.children(parent):
+                if job.tree.visible[child] and job.tree.get_name(child) == name:
+                    return child
+        return None
+
+    def hide_result(self, job, index):
+        tree = job.tree
+        if tree.change[index] == DIRECTORY:
+            prefix = tree.relpath(index)
+            for relpath in [relpath for relpath in job.dirs if relpath == prefix or relpath.startswith(prefix + os.sep)]:
+                del job.dirs[relpath]
+        self.file_browser.remove_index(index)
+
+        #Folders are only shown while something inside them is different
+        parent = tree.parent[index]
+        while parent != tree.ROOT and not tree.has_visible_children(parent):
+            job.dirs.pop(tree.relpath(parent), None)
+            self.file_browser.remove_index(parent)
+            parent = tree.parent[parent]
+
+    def apply_live_changes(self, job, results):
+        self.rechecking = False
+        if job is not self.live_job:
+            return
+        tree = job.tree
+        new = []
+        for relpath, change, is_dir in results:
+            shown = change in (CHANGED, LEFT_ONLY, RIGHT_ONLY) or (change == UNCHANGED and job.show_all)
+            index = self.find_result(job, relpath)
+            if index is not None:
+                if tree.change[index] == change and (shown or change == DIRECTORY):
+                    continue
+                self.hide_result(job, index)
+            if shown:
+                parent_relpath, name = os.path.split(relpath)
+                parent = self.get_scan_parent(job, parent_relpath, new)
+                new.append(tree.add(parent, name, change, get_icon_name(name, is_dir)))
+
+        if new:
+            self.file_browser.add_items(new)
+            if self.no_results:
+                self.content_pane.set_start_child(self.file_browser)
+                self.no_results = False
+        elif self.file_browser.store.get_n_items() == 0 and not self.no_results:
+            self.content_pane.set_start_child(self.no_results_container)
+            self.no_results = True
+
+    def cancel_scan(self):
+        if self.scan_job:
+            self.scan_job.cancellable.cancel()
+            self.scan_job = None
 
     def prepare_scan_manual(self, *args):
         if self.open_button1.folder and self.open_button2.folder:
-            self.master_container.append(self.footer_bar)
+            self.cancel_scan()
+            self.stop_watching()
+            if self.footer_bar.get_parent() is None:
+                self.master_container.append(self.footer_bar)
             self.content_pane.set_end_child(None)
-            self.file_browser.store.remove_all()
+            tree = ResultTree(self.open_button1.folder, self.open_button2.folder)
+            self.file_browser.set_tree(tree)
             self.spinner.start()
             self.searching = True
+            self.scan_job = job = ScanJob(tree)
+            self.start_result_flushing()
 
-            thread = threading.Thread(target=self.begin_scanning, daemon = True)
+            thread = threading.Thread(target=profiled(lambda job=job: self.begin_scanning(job), "scan"), daemon = True)
             thread.start()
 
 class MyApp(Adw.Application):
@@ -898,7 +1976,28 @@ class MyApp(Adw.Application):
 
     def on_activate(self, app):
         self.win = MainWindow(app)
+        mark_startup("window")
+        self.win.connect("map", self.on_window_mapped)
         self.win.present()
 
-app = MyApp(application_id=SCHEMA_ID)
-app.run(sys.argv)
+    def on_window_mapped(self, window):
+        clock = window.get_frame_clock()
+        handler = None
+        def on_after_paint(clock):
+            clock.disconnect(handler)
+            mark_startup("first frame")
+        handler = clock.connect("after-paint", on_after_paint)
+
+def main():
+    global gio_settings, profiler
+    gio_settings = Gio.Settings.new(SCHEMA_ID)
+    mark_startup("settings")
+    if PROFILE or gio_settings.get_boolean("profiling"):
+        from PathfinderProfile import Profiler #pulls in cProfile, pstats and tracemalloc, so only when asked for
+        profiler = Profiler(memory=PROFILE != "cpu")
+        print("Profiling scans and diffs; profiles are written to", profiler.folder)
+    app = MyApp(application_id=SCHEMA_ID)
+    return app.run(sys.argv)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Opt-in profiling for PathFinderGTK.
+
+Functions wrapped with Profiler.wrap() run under cProfile, one profile per
+call, and the profiles are grouped by kind (such as "scan" or "diff"). dump()
+merges the profiles of one kind and writes them to the user cache folder, next
+to a tracemalloc snapshot, so they can be attached to bug reports. Nothing here
+imports GTK.
+"""
+import os, threading, functools, cProfile, pstats, tracemalloc
+from PathfinderScan import user_cache_dir, timestamped_name
+
+TOP_FUNCTIONS = 40 #functions listed in the text summary
+TOP_ALLOCATIONS = 25 #lines listed in the text summary
+
+class Profiler:
+    """Collects profiles of wrapped functions, from any thread.
+
+    Profiles are written by a background thread. A dump asked for while
+    functions of that kind are still running waits for them to finish, so
+    a scan's profile includes its thread even if the GUI hears about the end
+    of the scan first. With memory set, allocations are traced as well, which
+    makes everything slower, but slows it down evenly.
+    """
+    def __init__(self, folder=None, memory=True):
+        self.folder = folder or os.path.join(user_cache_dir(), "profiles")
+        self.memory = memory
+        self.profiles = {}
+        self.running = {}
+        self.generations = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def wrap(self, function, kind, last=False):
+        """Return function wrapped so it is profiled; with last set, the profiles of kind are dumped after each call."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                if getattr(self.local, "profiling", False):
+                    return function(*args, **kwargs) #already counted by the call this one came from
+                return self.profile(function, kind, args, kwargs)
+            finally:
+                if last:
+                    self.dump(kind)
+        return wrapper
+
+    def profile(self, function, kind, args, kwargs):
+        #Each thread keeps one profile per kind until the next dump, so a pool running thousands of small jobs does not make thousands of profiles
+        profiles = self.local.__dict__.setdefault("profiles", {})
+        with self.lock:
+            self.running[kind] = self.running.get(kind, 0) + 1
+            generation = self.generations.get(kind, 0)
+            entry = profiles.get(kind)
+            if entry is None or entry[0] != generation:
+                entry = profiles[kind] = (generation, cProfile.Profile())
+                self.profiles.setdefault(kind, []).append(entry[1])
+        profile = entry[1]
+        try:
+            try:
+                profile.enable()
+            except ValueError:
+                #Since Python 3.12 only one profiler can run at a time, and it sees every thread
+                return function(*args, **kwargs)
+            self.local.profiling = True
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.local.profiling = False
+        finally:
+            with self.lock:
+                self.running[kind] -= 1
+                ready = kind in self.pending and not self.running[kind]
+            if ready:
+                self.dump(kind)
+
+    def dump(self, kind):
+        with self.lock:
+            if self.running.get(kind):
+                self.pending.add(kind)
+                return
+            self.pending.discard(kind)
+            profiles = self.profiles.pop(kind, [])
+            self.generations[kind] = self.generations.get(kind, 0) + 1
+        if profiles:
+            threading.Thread(target=self.write, args=(kind, profiles), daemon=True).start()
+
+    def write(self, kind, profiles):
+        snapshot = None
+        if self.memory and tracemalloc.is_tracing():
+            #Before anything below allocates memory of its own
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            path = os.path.join(self.folder, timestamped_name(kind))
+            with open(path + ".txt", "w") as file:
+                stats = pstats.Stats(stream=file)
+                for profile in profiles:
+                    profile.create_stats()
+                    if profile.stats: #threads that could not start their profiler have none
+                        stats.add(profile)
+                stats.dump_stats(path + ".prof")
+                file.write(f"{kind}: profiled on {len(profiles)} threads, view {path}.prof with python3 -m pstats\n")
+                stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+                if snapshot:
+                    snapshot.dump(path + ".tracemalloc")
+                    file.write(f"Traced memory: {current:,} bytes now, at most {peak:,} bytes since the last profile\n\n")
+                    for statistic in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                        file.write(f"{statistic}\n")
+        except OSError as error:
+            print("Could not write the profile:", error)
+            return
+        print("Profile written to", path + ".txt")
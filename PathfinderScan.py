@@ -0,0 +1,1141 @@
+"""Directory comparison engine used by PathFinderGTK.
+
+Nothing in here imports GTK, so the scanner can also be driven from scripts and
+headless machines.
+"""
+import sys, os, re, stat, time, json, sqlite3, threading, hashlib, random, argparse
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from filecmp import DEFAULT_IGNORES
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+BUFSIZE = 8*1024
+HASH_BUFSIZE = 1024*1024
+SAMPLE_SIZE = 64*1024
+DEFAULT_WORKERS = 4
+DEFAULT_SAMPLES = 8
+INDEX_VERSION = 3
+INDEX_FLUSH_INTERVAL = 500
+RACY_WINDOW = 3*10**9 #ns after a directory changes during which its listing is not reused
+
+CHECK_INTERVAL = 1024*1024 #bytes read between checks for cancellation
+RATE_WINDOW = 2.0 #seconds the rolling rates are averaged over
+REPORT_LIMIT = 50 #scan reports kept in the user cache folder
+
+#Where scanning threads spend their time, see ScanStats
+PHASES = ("list", "stat", "compare", "index")
+
+KIND_FILE = 0
+KIND_DIR = 1
+KIND_OTHER = 2
+
+COMPARE_SHALLOW = "shallow" #stat, then a full read if the modification times differ (filecmp's default)
+COMPARE_STAT = "stat"
+COMPARE_SAMPLED = "sampled"
+COMPARE_HASH = "hash"
+COMPARE_MODES = (COMPARE_SHALLOW, COMPARE_STAT, COMPARE_SAMPLED, COMPARE_HASH)
+
+#Change codes stored in ResultTree
+UNCHANGED = 0
+CHANGED = 1
+LEFT_ONLY = 2
+RIGHT_ONLY = 3
+DIRECTORY = 4 #a common directory with changes somewhere inside
+MOVED = 5 #only in the left folder, but the same data is somewhere else in the right one
+
+class ScanCancelled(Exception):
+    pass
+
+class DirComparison:
+    """The result of comparing one pair of directories.
+
+    Uses the same names as filecmp.dircmp, except that subdirs is a list of the
+    names of common subdirectories; the walker compares those separately.
+    only_dirs holds the names in left_only and right_only that are directories.
+    """
+    __slots__ = ("relpath", "left", "right", "diff_files", "left_only", "right_only", "same_files", "subdirs", "only_dirs", "error")
+
+    def __init__(self, relpath, left, right):
+        self.relpath = relpath
+        self.left = left
+        self.right = right
+        self.diff_files = []
+        self.left_only = []
+        self.right_only = []
+        self.same_files = []
+        self.subdirs = []
+        self.only_dirs = set()
+        self.error = None
+
+    def has_changes(self):
+        return bool(self.diff_files or self.left_only or self.right_only)
+
+def entry_kind(entry):
+    try:
+        if entry.is_dir():
+            return KIND_DIR
+        if entry.is_file():
+            return KIND_FILE
+    except OSError:
+        pass
+    return KIND_OTHER
+
+def list_dir(path):
+    with os.scandir(path) as it:
+        return {entry.name: entry for entry in it}
+
+def translate_pattern(pattern):
+    #The regular expression for one gitignore-style pattern, without its leading "!", "/" or trailing "/"
+    parts = []
+    position = 0
+    length = len(pattern)
+    while position < length:
+        char = pattern[position]
+        if pattern.startswith("**/", position) and (position == 0 or pattern[position - 1] == "/"):
+            parts.append("(?:.*/)?")
+            position += 3
+            continue
+        if pattern.startswith("**", position) and position + 2 == length and (position == 0 or pattern[position - 1] == "/"):
+            parts.append(".*")
+            position += 2
+            continue
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[":
+            end = pattern.find("]", position + 2)
+            if end == -1:
+                parts.append(re.escape(char))
+            else:
+                chars = pattern[position + 1:end]
+                if chars[0] == "!":
+                    chars = "^" + chars[1:]
+                parts.append("[" + chars.replace("\\", "\\\\") + "]")
+                position = end
+        elif char == "\\" and position + 1 < length:
+            position += 1
+            parts.append(re.escape(pattern[position]))
+        else:
+            parts.append(re.escape(char))
+        position += 1
+    return "".join(parts)
+
+class PathFilter:
+    """gitignore-style patterns, compiled into a few regular expressions.
+
+    A pattern without a slash matches a name at any depth, one with a slash
+    matches a path from the top of the two folders. "*" and "?" do not match
+    slashes, "**" matches any number of folders, a trailing slash only matches
+    folders and a leading "!" brings back something an earlier pattern left
+    out. As in git, the last pattern that matches wins, and nothing inside a
+    folder that is left out can be brought back, since it is never listed.
+    """
+    def __init__(self, patterns):
+        self.patterns = []
+        #Runs of patterns of the same sign, in order: (include, {(whole path, folders only): [regex, ...]})
+        groups = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            self.patterns.append(pattern)
+            include = pattern.startswith("!")
+            if include:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = "/" in pattern
+            pattern = pattern.lstrip("/")
+            if not pattern:
+                continue
+            if not groups or groups[-1][0] != include:
+                groups.append((include, {}))
+            groups[-1][1].setdefault((anchored, dir_only), []).append(translate_pattern(pattern))
+        #Checked last pattern first, so the first group that matches decides
+        self.groups = [(include, {key: re.compile("(?:" + "|".join(regexes) + r")\Z") for key, regexes in kinds.items()})
+                       for include, kinds in reversed(groups)]
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    def excluded(self, relpath, is_dir=False):
+        """Whether the entry at relpath is left out; only the entry itself is looked at, not the folders it is in."""
+        name = os.path.basename(relpath)
+        for include, kinds in self.groups:
+            for (anchored, dir_only), regex in kinds.items():
+                if (is_dir or not dir_only) and regex.match(relpath if anchored else name):
+                    return not include
+        return False
+
+    def excluded_path(self, relpath, is_dir=False):
+        #Also looks at every folder relpath is in, for entries that are not found by walking down from the top
+        parent = os.path.dirname(relpath)
+        return (parent and self.excluded_path(parent, True)) or self.excluded(relpath, is_dir)
+
+def user_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "pathfinder")
+
+def per_second(count, seconds):
+    return count/seconds if seconds > 0 else 0.0
+
+def timestamped_name(prefix):
+    #Sorts by time, and two files made in the same second still get different names
+    now = time.time()
+    return prefix + time.strftime("-%Y%m%d-%H%M%S", time.localtime(now)) + f"-{int(now*1000)%1000:03d}"
+
+def write_report(report, path=None):
+    """Write a scan report as JSON, by default to a new file in the user cache folder.
+
+    Only the newest REPORT_LIMIT reports in the cache folder are kept. Returns
+    the path written to.
+    """
+    if path is None:
+        folder = os.path.join(user_cache_dir(), "reports")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, timestamped_name("scan") + ".json")
+        old = sorted(name for name in os.listdir(folder) if name.startswith("scan-") and name.endswith(".json"))
+        for name in old[:max(0, len(old) - REPORT_LIMIT + 1)]:
+            try:
+                os.unlink(os.path.join(folder, name))
+            except OSError:
+                pass
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+        file.write("\n")
+    return path
+
+class ScanStats:
+    """Counters and timings for one scan.
+
+    Each scanning thread adds its totals once per directory, so the lock is
+    taken rarely. Phase times are summed over all threads and are wall-clock
+    time, so with several workers they add up to more than the scan took and
+    include time spent waiting for the disk. bytes_compared counts the files
+    whose contents had to be read, whether or not the comparison stopped early.
+    Other phases (such as the GUI looking up icons) can be added with add_time().
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.start_time = time.time()
+        self.finished = None
+        self.dirs = 0
+        self.dirs_cached = 0 #listings taken from the scan index
+        self.files = 0
+        self.files_cached = 0 #verdicts taken from the scan index
+        self.files_compared = 0
+        self.bytes_compared = 0
+        self.errors = 0
+        self.moves = 0
+        self.queue_depth = 0 #directories queued or being compared, set by the walking thread
+        self.max_queue_depth = 0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.samples = deque()
+        self.lock = threading.Lock()
+
+    def add_dir(self, times, cached, files, files_cached, files_compared, bytes_compared, error=False):
+        with self.lock:
+            self.dirs += 1
+            self.dirs_cached += cached
+            self.files += files
+            self.files_cached += files_cached
+            self.files_compared += files_compared
+            self.bytes_compared += bytes_compared
+            self.errors += error
+            for phase, seconds in times.items():
+                self.phases[phase] += seconds
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def set_queue_depth(self, depth):
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def rates(self):
+        """Return directories, files and bytes compared per second over the last RATE_WINDOW seconds.
+
+        Meant to be called regularly from one thread, such as a GUI timer.
+        """
+        now = time.monotonic()
+        sample = (now, self.dirs, self.files, self.bytes_compared)
+        self.samples.append(sample)
+        while len(self.samples) > 2 and now - self.samples[1][0] >= RATE_WINDOW:
+            self.samples.popleft()
+        first = self.samples[0]
+        seconds = now - first[0]
+        return tuple(per_second(value - old, seconds) for value, old in zip(sample[1:], first[1:]))
+
+    def report(self):
+        seconds = self.elapsed()
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.start_time)),
+            "seconds": round(seconds, 3),
+            "counts": {"dirs": self.dirs, "dirs_from_index": self.dirs_cached, "files": self.files,
+                       "files_from_index": self.files_cached, "files_compared": self.files_compared,
+                       "bytes_compared": self.bytes_compared, "errors": self.errors, "moves": self.moves,
+                       "max_queue_depth": self.max_queue_depth},
+            "rates": {"dirs_per_second": round(per_second(self.dirs, seconds), 1),
+                      "files_per_second": round(per_second(self.files, seconds), 1),
+                      "bytes_compared_per_second": round(per_second(self.bytes_compared, seconds))},
+            "phase_seconds": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+        }
+
+def stat_signature(st):
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+def is_racy(st, listed_ns):
+    #Like git's racy entries: a change made in the same timestamp tick as the listing leaves the directory's mtime as it was.
+    #Timestamps can be coarse (FAT keeps even seconds) or lag the clock (jiffies on ext4), so a fixed margin covers both
+    return listed_ns < st.st_mtime_ns + RACY_WINDOW
+
+class ScanIndex:
+    """On-disk record of what the last scan of a pair of folders saw.
+
+    Directories are stored with the signatures of both sides, their listings
+    and when they were listed, so an unchanged pair of directories does not
+    need to be listed again. Files
+    are stored with the signatures of both sides and whether they matched, so
+    unchanged pairs are not compared again. Lookups may come from any thread;
+    writes are queued and written by whoever calls flush().
+    """
+    def __init__(self, left, right, path=None):
+        self.path = path or os.path.join(user_cache_dir(), "index.sqlite3")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._dirs = []
+        self._files = []
+        self._stale = []
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = self.connect()
+        if conn.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS pairs")
+                conn.execute("DROP TABLE IF EXISTS dirs")
+                conn.execute("DROP TABLE IF EXISTS files")
+                conn.execute("CREATE TABLE pairs (id INTEGER PRIMARY KEY, left TEXT, right TEXT, UNIQUE (left, right))")
+                conn.execute("CREATE TABLE dirs (pair INTEGER, relpath TEXT, left_sig TEXT, right_sig TEXT, entries TEXT, listed INTEGER, PRIMARY KEY (pair, relpath))")
+                conn.execute("CREATE TABLE files (pair INTEGER, dir TEXT, name TEXT, left_sig TEXT, right_sig TEXT, mode TEXT, same INTEGER, PRIMARY KEY (pair, dir, name))")
+                conn.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO pairs (left, right) VALUES (?, ?)", (left, right))
+        self.pair = conn.execute("SELECT id FROM pairs WHERE left = ? AND right = ?", (left, right)).fetchone()[0]
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def get_dir(self, relpath):
+        row = self.connect().execute("SELECT left_sig, right_sig, entries, listed FROM dirs WHERE pair = ? AND relpath = ?", (self.pair, relpath)).fetchone()
+        if row:
+            left_kinds, right_kinds = json.loads(row[2])
+            return row[0], row[1], left_kinds, right_kinds, row[3]
+
+    def get_files(self, relpath):
+        rows = self.connect().execute("SELECT name, left_sig, right_sig, mode, same FROM files WHERE pair = ? AND dir = ?", (self.pair, relpath))
+        return {name: (left_sig, right_sig, mode, bool(same)) for name, left_sig, right_sig, mode, same in rows}
+
+    def put_dir(self, relpath, left_sig, right_sig, left_kinds, right_kinds, listed):
+        with self._lock:
+            self._dirs.append((self.pair, relpath, left_sig, right_sig, json.dumps((left_kinds, right_kinds)), listed))
+            self._stale.append((self.pair, relpath))
+
+    def put_files(self, relpath, rows):
+        with self._lock:
+            self._files.extend((self.pair, relpath, name, left_sig, right_sig, mode, same) for name, left_sig, right_sig, mode, same in rows)
+
+    def flush(self):
+        with self._lock:
+            dirs, self._dirs = self._dirs, []
+            files, self._files = self._files, []
+            stale, self._stale = self._stale, []
+        if dirs or files:
+            with self.connect() as conn:
+                #A directory that had to be listed again gets a fresh set of file rows
+                conn.executemany("DELETE FROM files WHERE pair = ? AND dir = ?", stale)
+                conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)", dirs)
+                conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", files)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+class ResultTree:
+    """Scan results kept in flat arrays, one slot per entry.
+
+    Names and icon names are interned, parents are indices into the same arrays
+    and paths are rebuilt when asked for, so an entry costs a few dozen bytes
+    instead of a Python object holding its own path strings. Entry 0 is the root.
+
+    add() may be called from a scanning thread. Entries only show up in
+    children() once link() has been called for them, which the GUI does from
+    its main thread. MOVED entries live at their place in the left folder;
+    moved holds where they are in the right one.
+    """
+    ROOT = 0
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.names = [""]
+        self.icons = [None]
+        self._name_ids = {"": 0}
+        self._icon_ids = {None: 0}
+        self._lock = threading.Lock()
+
+        self.name = array('i', [0])
+        self.parent = array('i', [-1])
+        self.change = array('b', [DIRECTORY])
+        self.icon = array('H', [0])
+        self.first_child = array('i', [-1])
+        self.last_child = array('i', [-1])
+        self.next_sibling = array('i', [-1])
+        self.visible = bytearray(b'\x01')
+        self.moved = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    def intern_icon(self, icon):
+        icon_id = self._icon_ids.get(icon)
+        if icon_id is None:
+            icon_id = self._icon_ids[icon] = len(self.icons)
+            self.icons.append(icon)
+        return icon_id
+
+    def add(self, parent, name, change, icon=None, moved_from=None):
+        with self._lock:
+            name_id = self._name_ids.get(name)
+            if name_id is None:
+                name_id = self._name_ids[name] = len(self.names)
+                self.names.append(name)
+
+            index = len(self.parent)
+            self.name.append(name_id)
+            self.parent.append(parent)
+            self.change.append(change)
+            self.icon.append(self.intern_icon(icon))
+            self.first_child.append(-1)
+            self.last_child.append(-1)
+            self.next_sibling.append(-1)
+            self.visible.append(1)
+            if moved_from is not None:
+                self.moved[index] = moved_from
+            return index
+
+    def link(self, index):
+        parent = self.parent[index]
+        last = self.last_child[parent]
+        if last == -1:
+            self.first_child[parent] = index
+        else:
+            self.next_sibling[last] = index
+        self.last_child[parent] = index
+
+    def children(self, index):
+        child = self.first_child[index]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def visible_children(self, index):
+        return [child for child in self.children(index) if self.visible[child]]
+
+    def has_visible_children(self, index):
+        return any(self.visible[child] for child in self.children(index))
+
+    def get_name(self, index):
+        return self.names[self.name[index]]
+
+    def get_icon(self, index):
+        return self.icons[self.icon[index]]
+
+    def set_icon(self, index, icon):
+        with self._lock:
+            self.icon[index] = self.intern_icon(icon)
+
+    def relpath(self, index):
+        parts = []
+        while index > 0:
+            parts.append(self.names[self.name[index]])
+            index = self.parent[index]
+        return os.path.join(*reversed(parts)) if parts else ""
+
+    def path(self, index):
+        #Entries that only exist in the right folder live there, everything else is listed from the left
+        root = self.right if self.change[index] == RIGHT_ONLY else self.left
+        return os.path.join(root, self.relpath(index))
+
+    def alternate_path(self, index):
+        if self.change[index] == MOVED:
+            return os.path.join(self.right, self.moved[index])
+        root = self.left if self.change[index] == RIGHT_ONLY else self.right
+        return os.path.join(root, self.relpath(index))
+
+def contents_equal(path1, path2, bufsize=BUFSIZE, check=None):
+    #check, if given, is called every CHECK_INTERVAL bytes and may raise to stop
+    blocks = max(1, CHECK_INTERVAL//bufsize)
+    with open(path1, 'rb') as file1, open(path2, 'rb') as file2:
+        count = 0
+        while True:
+            block1 = file1.read(bufsize)
+            block2 = file2.read(bufsize)
+            if block1 != block2:
+                return False
+            if not block1:
+                return True
+            count += 1
+            if check and count % blocks == 0:
+                check()
+
+def new_hasher():
+    if xxhash:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+def file_digest(path, bufsize=HASH_BUFSIZE, check=None):
+    hasher = new_hasher()
+    buffer = bytearray(bufsize)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            size = file.readinto(buffer)
+            if not size:
+                return hasher.digest()
+            hasher.update(view[:size])
+            if check:
+                check()
+
+def samples_equal(path1, path2, size, samples, block=SAMPLE_SIZE, check=None):
+    """Compare the first and last blocks of two files of the same size, plus a few random ones."""
+    if size <= block*(samples + 2):
+        return contents_equal(path1, path2, HASH_BUFSIZE, check)
+    offsets = [0, size - block] + random.sample(range(block, size - block), samples)
+    with open(path1, 'rb') as file1, open(path2, 'rb') as file2:
+        for offset in sorted(offsets):
+            file1.seek(offset)
+            file2.seek(offset)
+            if file1.read(block) != file2.read(block):
+                return False
+    return True
+
+def quick_digest(path, size, block=SAMPLE_SIZE, check=None):
+    #The first and last blocks; for small files that is the whole file, so the same as file_digest()
+    if size <= 2*block:
+        return file_digest(path, check=check)
+    hasher = new_hasher()
+    with open(path, 'rb') as file:
+        hasher.update(file.read(block))
+        file.seek(size - block)
+        hasher.update(file.read(block))
+    return hasher.digest()
+
+def list_tree(path, ignore=(), excluded=None, check=None):
+    """Return every file and folder below path as sorted (relative path, size) pairs, with None as the size of folders.
+
+    excluded, if given, is called with each relative path and whether it is a
+    folder, and returns True for entries to leave out. check, if given, is
+    called before each folder is listed.
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(path, onerror=raise_error):
+        if check:
+            check()
+        relpath = os.path.relpath(dirpath, path)
+        dirnames[:] = [name for name in dirnames if name not in ignore
+                       and not (excluded and excluded(os.path.normpath(os.path.join(relpath, name)), True))]
+        for name in dirnames:
+            entries.append((os.path.normpath(os.path.join(relpath, name)), None))
+        for name in filenames:
+            if name not in ignore and not (excluded and excluded(os.path.normpath(os.path.join(relpath, name)), False)):
+                entries.append((os.path.normpath(os.path.join(relpath, name)), os.lstat(os.path.join(dirpath, name)).st_size))
+    entries.sort()
+    return entries
+
+def raise_error(error):
+    raise error
+
+def pair_up(lefts, rights):
+    #Entries that hold the same data; the ones that kept their name were only moved, so pair those first
+    pairs = []
+    rights_by_name = {}
+    for relpath in sorted(rights):
+        rights_by_name.setdefault(os.path.basename(relpath), []).append(relpath)
+    unpaired = []
+    for relpath in sorted(lefts):
+        same_name = rights_by_name.get(os.path.basename(relpath))
+        if same_name:
+            pairs.append((relpath, same_name.pop(0)))
+        else:
+            unpaired.append(relpath)
+    others = sorted(relpath for names in rights_by_name.values() for relpath in names)
+    pairs.extend(zip(unpaired, others))
+    return pairs
+
+class ScanEngine:
+    """Compares two folders.
+
+    cancellable can be anything with an is_cancelled() method, such as a
+    Gio.Cancellable. Once it is cancelled, walk() raises ScanCancelled soon
+    after, without waiting for the rest of the tree.
+
+    Names in ignore are skipped wherever they are; filters is a list of
+    gitignore-style patterns (see PathFilter), and folders they leave out are
+    never listed. Files bigger than compare_max_size bytes, or that have not
+    been modified on either side for compare_max_age seconds, are compared
+    by size and modification time only, whatever compare_mode says.
+    """
+    def __init__(self, left, right, workers=DEFAULT_WORKERS, ignore=DEFAULT_IGNORES, show_all=False, index=None,
+                 compare_mode=COMPARE_SHALLOW, samples=DEFAULT_SAMPLES, cancellable=None, filters=(),
+                 compare_max_size=None, compare_max_age=None):
+        if compare_mode not in COMPARE_MODES:
+            raise ValueError(f"Unknown comparison mode {compare_mode!r}")
+        self.left = left
+        self.right = right
+        self.workers = max(1, workers)
+        self.ignore = frozenset(ignore)
+        self.show_all = show_all
+        self.index = index
+        self.compare_mode = compare_mode
+        self.samples = max(0, samples)
+        self.cancellable = cancellable
+        self.check = self.check_cancelled if cancellable else None
+        self.hash_pool = None
+        self.stats = ScanStats()
+        self.filter = PathFilter(filters)
+        self.compare_max_size = compare_max_size
+        self.compare_min_mtime = time.time() - compare_max_age if compare_max_age else None
+
+    def check_cancelled(self):
+        if self.cancellable and self.cancellable.is_cancelled():
+            raise ScanCancelled()
+
+    def report(self):
+        """Return the settings and statistics of the last walk() as a dict, ready for write_report()."""
+        report = {"left": self.left, "right": self.right,
+                  "settings": {"workers": self.workers, "compare_mode": self.compare_mode, "samples": self.samples,
+                               "index": self.index is not None, "show_all": self.show_all, "filters": self.filter.patterns,
+                               "compare_max_size": self.compare_max_size, "compare_min_mtime": self.compare_min_mtime}}
+        report.update(self.stats.report())
+        return report
+
+    def file_mode(self, stat1, stat2):
+        #Files too big or too old to be worth reading are compared by their stat results only
+        if self.compare_max_size is not None and stat1.st_size > self.compare_max_size:
+            return COMPARE_STAT
+        if self.compare_min_mtime is not None and max(stat1.st_mtime, stat2.st_mtime) < self.compare_min_mtime:
+            return COMPARE_STAT
+        return self.compare_mode
+
+    def read_size(self, stat1, stat2, mode):
+        #How much files_equal() reads for a pair of files, at most
+        if stat1.st_size != stat2.st_size or mode == COMPARE_STAT:
+            return 0
+        if mode == COMPARE_SHALLOW and stat1.st_mtime == stat2.st_mtime:
+            return 0
+        if mode == COMPARE_SAMPLED and stat1.st_size > SAMPLE_SIZE*(self.samples + 2):
+            return 2*SAMPLE_SIZE*(self.samples + 2)
+        return 2*stat1.st_size
+
+    def files_equal(self, path1, path2, stat1, stat2, mode=None):
+        if stat1.st_size != stat2.st_size:
+            return False
+        mode = mode or self.file_mode(stat1, stat2)
+        if mode == COMPARE_SHALLOW:
+            #Same rules as filecmp.cmp(shallow=True), but with stat results we already have
+            return stat1.st_mtime == stat2.st_mtime or contents_equal(path1, path2, check=self.check)
+        elif mode == COMPARE_STAT:
+            return stat1.st_mtime == stat2.st_mtime
+        elif mode == COMPARE_SAMPLED:
+            return samples_equal(path1, path2, stat1.st_size, self.samples, check=self.check)
+        else:
+            #Hash the two sides at the same time, they are usually on different disks
+            if self.hash_pool and stat1.st_size > HASH_BUFSIZE:
+                digest1 = self.hash_pool.submit(file_digest, path1, check=self.check)
+                return file_digest(path2, check=self.check) == digest1.result()
+            return file_digest(path1, check=self.check) == file_digest(path2, check=self.check)
+
+    def compare_entry(self, relpath):
+        """Work out how a single entry differs now, for updating results without a new scan.
+
+        Returns (change, is_dir). change is None if the entry is gone from both
+        folders, is ignored, or is a file on one side and a folder on the other.
+        DIRECTORY means a folder exists on both sides; its contents are not looked at.
+        """
+        if os.path.basename(relpath) in self.ignore:
+            return None, False
+        stats = []
+        for root in (self.left, self.right):
+            try:
+                stats.append(os.stat(os.path.join(root, relpath)))
+            except FileNotFoundError:
+                stats.append(None)
+        left_stat, right_stat = stats
+
+        if left_stat is None and right_stat is None:
+            return None, False
+        if self.filter and self.filter.excluded_path(relpath, stat.S_ISDIR((left_stat or right_stat).st_mode)):
+            return None, False
+        if right_stat is None:
+            return LEFT_ONLY, stat.S_ISDIR(left_stat.st_mode)
+        if left_stat is None:
+            return RIGHT_ONLY, stat.S_ISDIR(right_stat.st_mode)
+        if stat.S_ISDIR(left_stat.st_mode) and stat.S_ISDIR(right_stat.st_mode):
+            return DIRECTORY, True
+        if stat.S_ISREG(left_stat.st_mode) and stat.S_ISREG(right_stat.st_mode):
+            same = self.files_equal(os.path.join(self.left, relpath), os.path.join(self.right, relpath), left_stat, right_stat)
+            return UNCHANGED if same else CHANGED, False
+        return None, False
+
+    def list_pair(self, relpath, left, right, times):
+        """Return the entry kinds of both directories, and their DirEntries if they had to be listed.
+
+        Time spent is added to the "list" and "index" entries of times.
+        """
+        clock = time.perf_counter
+        if self.index:
+            start = clock()
+            left_stat = os.stat(left)
+            right_stat = os.stat(right)
+            left_sig = stat_signature(left_stat)
+            right_sig = stat_signature(right_stat)
+            cached = self.index.get_dir(relpath)
+            times["index"] += clock() - start
+            if (cached and cached[0] == left_sig and cached[1] == right_sig
+                    and not is_racy(left_stat, cached[4]) and not is_racy(right_stat, cached[4])):
+                return cached[2], cached[3], None, None
+
+        start = clock()
+        listed = time.time_ns()
+        left_entries = list_dir(left)
+        right_entries = list_dir(right)
+        left_kinds = {name: entry_kind(entry) for name, entry in left_entries.items()}
+        right_kinds = {name: entry_kind(entry) for name, entry in right_entries.items()}
+        times["list"] += clock() - start
+        if self.index:
+            self.index.put_dir(relpath, left_sig, right_sig, left_kinds, right_kinds, listed)
+        return left_kinds, right_kinds, left_entries, right_entries
+
+    def compare_dir(self, relpath, strict=False):
+        left = os.path.join(self.left, relpath) if relpath else self.left
+        right = os.path.join(self.right, relpath) if relpath else self.right
+        result = DirComparison(relpath, left, right)
+        self.check_cancelled()
+        clock = time.perf_counter
+        times = dict.fromkeys(PHASES, 0.0)
+        files = files_cached = files_compared = bytes_compared = 0
+
+        try:
+            left_kinds, right_kinds, left_entries, right_entries = self.list_pair(relpath, left, right, times)
+        except OSError as error:
+            if strict:
+                raise
+            result.error = error
+            self.stats.add_dir(times, False, 0, 0, 0, 0, error=True)
+            return result
+
+        start = clock()
+        verdicts = self.index.get_files(relpath) if self.index else {}
+        times["index"] += clock() - start
+        new_verdicts = []
+        ignore = self.ignore
+        path_filter = self.filter or None
+
+        for name, left_kind in left_kinds.items():
+            if name in ignore or (path_filter and path_filter.excluded(os.path.join(relpath, name), left_kind == KIND_DIR)):
+                continue
+            right_kind = right_kinds.get(name)
+            if right_kind is None:
+                result.left_only.append(name)
+                if left_kind == KIND_DIR:
+                    result.only_dirs.add(name)
+            elif left_kind == KIND_DIR and right_kind == KIND_DIR:
+                result.subdirs.append(name)
+            elif left_kind == KIND_FILE and right_kind == KIND_FILE:
+                self.check_cancelled()
+                left_path = os.path.join(left, name)
+                right_path = os.path.join(right, name)
+                try:
+                    start = clock()
+                    left_stat = left_entries[name].stat() if left_entries else os.stat(left_path)
+                    right_stat = right_entries[name].stat() if right_entries else os.stat(right_path)
+                    times["stat"] += clock() - start
+                    files += 1
+                    mode = self.file_mode(left_stat, right_stat)
+                    same = None
+                    if self.index:
+                        left_sig = stat_signature(left_stat)
+                        right_sig = stat_signature(right_stat)
+                        cached = verdicts.get(name)
+                        if cached and cached[:3] == (left_sig, right_sig, mode):
+                            same = cached[3]
+                            files_cached += 1
+                            if left_entries:
+                                #The directory was listed again, so its rows are rewritten
+                                new_verdicts.append((name, left_sig, right_sig, mode, same))
+                    if same is None:
+                        start = clock()
+                        same = self.files_equal(left_path, right_path, left_stat, right_stat, mode)
+                        times["compare"] += clock() - start
+                        read = self.read_size(left_stat, right_stat, mode)
+                        if read:
+                            files_compared += 1
+                            bytes_compared += read
+                        if self.index:
+                            new_verdicts.append((name, left_sig, right_sig, mode, same))
+                except OSError:
+                    continue #unreadable pairs are skipped, like dircmp's funny_files
+                if not same:
+                    result.diff_files.append(name)
+                elif self.show_all:
+                    result.same_files.append(name)
+
+        if new_verdicts:
+            self.index.put_files(relpath, new_verdicts)
+
+        for name, right_kind in right_kinds.items():
+            if name not in left_kinds and name not in ignore and not (path_filter and path_filter.excluded(os.path.join(relpath, name), right_kind == KIND_DIR)):
+                result.right_only.append(name)
+                if right_kind == KIND_DIR:
+                    result.only_dirs.add(name)
+
+        self.stats.add_dir(times, left_entries is None, files, files_cached, files_compared, bytes_compared)
+        return result
+
+    def find_moves(self, left_only, right_only):
+        """Pair up entries only in the left folder with entries only in the right folder that hold the same data.
+
+        left_only and right_only are lists of (relpath, is_dir). Candidates are
+        first put in buckets by size, so only entries that have one of the same
+        size on the other side are read at all. Files are then compared by a
+        hash of their first and last blocks, then by a hash of all of their
+        data. Folders are compared by the number of files and folders directly
+        inside, so only folders with a match are walked at all, then by the
+        number and total size of all the files inside, then by their listing,
+        then by the data of every file. Empty
+        files and folders are left alone. Returns (left relpath, right relpath,
+        is_dir) tuples.
+        """
+        start = time.perf_counter()
+        moves = []
+        roots = (self.left, self.right)
+        pool = ThreadPoolExecutor(self.workers)
+        try:
+            for is_dir in (False, True):
+                groups = [tuple([relpath for relpath, entry_is_dir in entries if entry_is_dir == is_dir] for entries in (left_only, right_only))]
+                listings = {}
+                if is_dir:
+                    stages = (self.tree_entry_count,
+                              lambda path: self.tree_size(path, listings),
+                              lambda path: self.tree_listing_digest(path, listings),
+                              lambda path: self.tree_digest(path, listings))
+                else:
+                    stages = (self.file_size, self.file_quick_digest)
+                for stage in stages:
+                    groups = self.split_groups(groups, stage, roots, pool)
+                if not is_dir:
+                    #A file with a single candidate is compared with it directly, which saves hashing both
+                    pairs = [group for group in groups if len(group[0]) == 1 and len(group[1]) == 1]
+                    same = pool.map(lambda group: self.same_file(*(os.path.join(root, relpaths[0]) for root, relpaths in zip(roots, group))), pairs)
+                    groups = [group for group in groups if len(group[0]) > 1 or len(group[1]) > 1]
+                    groups = self.split_groups(groups, self.file_full_digest, roots, pool)
+                    groups.extend(group for group, equal in zip(pairs, same) if equal)
+                for lefts, rights in groups:
+                    moves.extend((left, right, is_dir) for left, right in pair_up(lefts, rights))
+        finally:
+            pool.shutdown(cancel_futures=True)
+        self.stats.moves += len(moves)
+        self.stats.add_time("moves", time.perf_counter() - start)
+        if self.stats.finished is not None:
+            self.stats.finish() #runs after walk(), and is part of the scan as far as its report goes
+        return moves
+
+    def split_groups(self, groups, key, roots, pool):
+        #Splits each (lefts, rights) group by key(path), keeping the parts that have entries on both sides
+        result = []
+        for group in groups:
+            if not group[0] or not group[1]:
+                continue
+            parts = {}
+            for side, relpaths in enumerate(group):
+                keys = pool.map(key, [os.path.join(roots[side], relpath) for relpath in relpaths])
+                for relpath, value in zip(relpaths, keys):
+                    if value is not None:
+                        parts.setdefault(value, ([], []))[side].append(relpath)
+            result.extend(part for part in parts.values() if part[0] and part[1])
+        return result
+
+    #Keys used by find_moves(); None leaves an entry out
+    def file_size(self, path):
+        self.check_cancelled()
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return None
+        return size or None
+
+    def file_quick_digest(self, path):
+        self.check_cancelled()
+        try:
+            return quick_digest(path, os.stat(path).st_size, check=self.check)
+        except OSError:
+            return None
+
+    def same_file(self, path1, path2):
+        self.check_cancelled()
+        try:
+            return os.stat(path1).st_size <= 2*SAMPLE_SIZE or contents_equal(path1, path2, HASH_BUFSIZE, self.check)
+        except OSError:
+            return False
+
+    def file_full_digest(self, path):
+        self.check_cancelled()
+        try:
+            size = os.stat(path).st_size
+            if size <= 2*SAMPLE_SIZE:
+                return True #quick_digest() already read all of it
+            return file_digest(path, check=self.check)
+        except OSError:
+            return None
+
+    def tree_filter(self, path):
+        #The filter for entries below path, which patterns see as paths from the top of the two folders
+        if not self.filter:
+            return None
+        prefix = os.path.relpath(path, self.left)
+        if prefix.startswith(os.pardir):
+            prefix = os.path.relpath(path, self.right)
+        return lambda relpath, is_dir: self.filter.excluded(os.path.join(prefix, relpath), is_dir)
+
+    def tree_entry_count(self, path):
+        #Only lists the folder itself, so folders without a likely match on the other side are never walked
+        self.check_cancelled()
+        excluded = self.tree_filter(path)
+        dirs = files = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if entry.name in self.ignore or (excluded and excluded(entry.name, is_dir)):
+                        continue
+                    if is_dir:
+                        dirs += 1
+                    else:
+                        files += 1
+        except OSError:
+            return None
+        return (dirs, files) if dirs or files else None
+
+    def tree_listing(self, path, listings):
+        listing = listings.get(path)
+        if listing is None:
+            self.check_cancelled()
+            listing = listings[path] = list_tree(path, self.ignore, self.tree_filter(path), self.check_cancelled)
+        return listing
+
+    def tree_size(self, path, listings):
+        try:
+            listing = self.tree_listing(path, listings)
+        except OSError:
+            return None
+        sizes = [size for relpath, size in listing if size is not None]
+        return (len(sizes), sum(sizes)) if sizes else None
+
+    def tree_listing_digest(self, path, listings):
+        return hashlib.blake2b(json.dumps(listings[path]).encode(), digest_size=16).digest()
+
+    def tree_digest(self, path, listings):
+        hasher = new_hasher()
+        try:
+            for relpath, size in listings[path]:
+                if size is not None:
+                    hasher.update(file_digest(os.path.join(path, relpath), check=self.check))
+        except OSError:
+            return None
+        return hasher.digest()
+
+    def walk(self, start=""):
+        """Yield a DirComparison for every pair of common directories.
+
+        Directories are compared on a pool of worker threads, so results are
+        yielded in completion order rather than tree order. Errors reading the
+        two starting folders are raised; errors further down are stored in
+        DirComparison.error. start is a path relative to both folders to begin
+        the walk from instead of the top.
+        """
+        if self.compare_mode == COMPARE_HASH:
+            self.hash_pool = ThreadPoolExecutor(self.workers)
+        try:
+            yield from self._walk(start)
+        finally:
+            if self.hash_pool:
+                self.hash_pool.shutdown()
+                self.hash_pool = None
+            if self.index:
+                self.flush_index()
+            self.stats.finish()
+
+    def flush_index(self):
+        start = time.perf_counter()
+        self.index.flush()
+        self.stats.add_time("index", time.perf_counter() - start)
+
+    def _walk(self, start):
+        root = self.compare_dir(start, strict=True)
+        yield root
+        count = 0
+
+        pending = deque(os.path.join(start, name) for name in root.subdirs)
+        pool = ThreadPoolExecutor(self.workers)
+        try:
+            running = set()
+            while pending or running:
+                self.check_cancelled()
+                #Keep the queue short and depth-first so memory does not grow with the tree
+                while pending and len(running) < self.workers*2:
+                    running.add(pool.submit(self.compare_dir, pending.pop()))
+                self.stats.set_queue_depth(len(pending) + len(running))
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    pending.extend(os.path.join(result.relpath, name) for name in result.subdirs)
+                    yield result
+                    count += 1
+                    if self.index and count % INDEX_FLUSH_INTERVAL == 0:
+                        self.flush_index()
+        finally:
+            #Stopping early (cancelled, or the caller stopped iterating) drops the queued work
+            pool.shutdown(cancel_futures=True)
+
+CHANGE_NAMES = {UNCHANGED: "unchanged", CHANGED: "changed", LEFT_ONLY: "left-only", RIGHT_ONLY: "right-only", MOVED: "moved"}
+
+def write_change(out, relpath, name, change, is_dir=False, right_path=None):
+    record = {"change": CHANGE_NAMES[change], "path": os.path.join(relpath, name), "type": "dir" if is_dir else "file"}
+    if right_path is not None:
+        record["right_path"] = right_path
+    out.write(json.dumps(record) + "\n")
+
+def main(argv=None):
+    """Compare two folders without the GUI, printing one JSON object per difference.
+
+    Exits with 0 if the folders match, 1 if there are differences and 2 if
+    something could not be read, like diff does.
+    """
+    parser = argparse.ArgumentParser(prog="PathfinderGTK.py --cli", description="Compare two folders and print the differences as JSON lines.",
+                                     epilog='Each line is {"change": CHANGE, "path": PATH, "type": "file" or "dir"}, where CHANGE is '
+                                            'one of changed, left-only, right-only, unchanged (with --show-all) or moved (with --moves) '
+                                            'and PATH is relative to both folders. Moved entries have PATH in the left folder and '
+                                            'add "right_path", where the same data is in the right folder.')
+    parser.add_argument("left", help="the original folder")
+    parser.add_argument("right", help="the backup folder")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of scanning threads (default: %(default)s)")
+    parser.add_argument("--mode", choices=COMPARE_MODES, default=COMPARE_SHALLOW, help="how closely files are compared (default: %(default)s)")
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES, help="random blocks to read in sampled mode (default: %(default)s)")
+    parser.add_argument("--index", action="store_true", help="reuse and update the scan index in the user cache folder")
+    parser.add_argument("--show-all", action="store_true", help="also print files that are the same")
+    parser.add_argument("--report", metavar="FILE", help="write counters and timings of the scan to FILE as JSON")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN", help="leave out entries matching this gitignore-style pattern; may be given more than once")
+    parser.add_argument("--exclude-from", metavar="FILE", help="read more patterns from FILE, one per line, like a .gitignore")
+    parser.add_argument("--compare-max-size", type=int, metavar="MIB", help="compare files bigger than this by size and modification time only")
+    parser.add_argument("--compare-max-age", type=int, metavar="DAYS", help="compare files not modified on either side for this long by size and modification time only")
+    parser.add_argument("--moves", action="store_true", help="report entries that were moved or renamed as such; delays the left-only and right-only lines until the end")
+    args = parser.parse_args(argv)
+    filters = list(args.exclude)
+    if args.exclude_from:
+        try:
+            with open(args.exclude_from) as file:
+                filters.extend(file.read().splitlines())
+        except OSError as error:
+            parser.error(str(error))
+
+    out = sys.stdout
+    differences = False
+    errors = False
+    left_only = []
+    right_only = []
+    index = None
+    try:
+        if args.index:
+            #Keyed by absolute paths, so runs from different folders do not share entries
+            index = ScanIndex(os.path.abspath(args.left), os.path.abspath(args.right))
+        engine = ScanEngine(args.left, args.right, args.workers, show_all=args.show_all, index=index,
+                            compare_mode=args.mode, samples=args.samples, filters=filters,
+                            compare_max_size=args.compare_max_size*1024*1024 if args.compare_max_size else None,
+                            compare_max_age=args.compare_max_age*86400 if args.compare_max_age else None)
+        for dcmp in engine.walk():
+            relpath = dcmp.relpath
+            if dcmp.error:
+                print(f"{os.path.join(args.left, relpath)}: {dcmp.error}", file=sys.stderr)
+                errors = True
+            for name in dcmp.diff_files:
+                write_change(out, relpath, name, CHANGED)
+            if args.moves:
+                left_only.extend((os.path.join(relpath, name), name in dcmp.only_dirs) for name in dcmp.left_only)
+                right_only.extend((os.path.join(relpath, name), name in dcmp.only_dirs) for name in dcmp.right_only)
+            else:
+                for name in dcmp.left_only:
+                    write_change(out, relpath, name, LEFT_ONLY, name in dcmp.only_dirs)
+                for name in dcmp.right_only:
+                    write_change(out, relpath, name, RIGHT_ONLY, name in dcmp.only_dirs)
+            for name in dcmp.same_files:
+                write_change(out, relpath, name, UNCHANGED)
+            if dcmp.has_changes():
+                differences = True
+        if left_only or right_only:
+            moves = engine.find_moves(left_only, right_only) if left_only and right_only else []
+            moved = set()
+            for left, right, is_dir in moves:
+                write_change(out, "", left, MOVED, is_dir, right)
+                moved.update(((left, is_dir), (right, is_dir)))
+            for entries, change in ((left_only, LEFT_ONLY), (right_only, RIGHT_ONLY)):
+                for entry in entries:
+                    if entry not in moved:
+                        write_change(out, "", entry[0], change, entry[1])
+        out.flush()
+        if args.report:
+            write_report(engine.report(), args.report)
+    except BrokenPipeError:
+        #The reader went away (e.g. "| head"); stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+        return 2
+    except (OSError, sqlite3.Error) as error:
+        print(error, file=sys.stderr)
+        return 2
+    finally:
+        if index:
+            try:
+                index.close()
+            except sqlite3.Error as error:
+                print(f"Could not write the scan index: {error}", file=sys.stderr)
+                errors = True
+
+    if errors:
+        return 2
+    return 1 if differences else 0
+
+if __name__ == "__main__":
+    sys.exit(main())